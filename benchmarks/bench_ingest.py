@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the document by document add_data with the batch_ingest mode.
+
+    python -m benchmarks.bench_ingest [documents] [query_keys]
+
+The rules never reach threshold_cur, so batch_ingest appends each query_key's
+documents in runs, only checking that the windows can't spike.
+"""
+import datetime
+import os
+import sys
+import time
+
+if __name__ == '__main__' and not __package__:
+    # Run as python benchmarks/bench_ingest.py
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.generators import documents
+from benchmarks.generators import new_rule
+
+
+def timed(rule_type, data, page=10000, **kwargs):
+    rule = new_rule(rule_type, datetime.timedelta(seconds=30), **kwargs)
+    start = time.time()
+    for offset in xrange(0, len(data), page):
+        rule.add_data(data[offset:offset + page])
+    return time.time() - start, len(rule.matches)
+
+
+def main(size=100000, keys=100):
+    data = documents(size, keys)
+    cases = [('PercentileOfFieldSpikeRule', 'PercentileOfFieldSpikeRule', {'keys': keys}),
+             ('PercentileOfFieldSpikeRule pane', 'PercentileOfFieldSpikeRule', {'keys': keys, 'window_mode': 'pane'}),
+             ('SumOfFieldSpikeRule', 'SumOfFieldSpikeRule', {}),
+             ('SumOfFieldSpikeRule pane', 'SumOfFieldSpikeRule', {'window_mode': 'pane'})]
+
+    for name, rule_type, options in cases:
+        single, single_matches = timed(rule_type, data, **options)
+        batch, batch_matches = timed(rule_type, data, batch_ingest=True, **options)
+        assert single_matches == batch_matches
+        print('%-32s %8d docs  add_data %7.0f docs/s  batch_ingest %7.0f docs/s  speedup %.2fx' % (
+            name, size, size / single, size / batch, single / batch))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Resident memory of the percentile windows holding buffered events.
+
+    python -m benchmarks.bench_memory [events]
+
+Each window is filled in its own process and the growth of the peak RSS is
+reported per million events.
+"""
+import datetime
+import multiprocessing
+import os
+import resource
+import sys
+
+import dateutil.tz
+
+if __name__ == '__main__' and not __package__:
+    # Run as python benchmarks/bench_memory.py
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from custom.compact import CompactEventWindow
+from custom.ruletypes import CustomEventWindow
+from elastalert.ruletypes import new_get_event_ts
+
+
+def windows():
+    timeframe = datetime.timedelta(days=365)
+    return [('CustomEventWindow', lambda: CustomEventWindow(timeframe, None, new_get_event_ts('@timestamp'), 90)),
+            ('CompactEventWindow', lambda: CompactEventWindow(timeframe, None, '@timestamp', 90))]
+
+
+def fill(new_window, size, results):
+    start = datetime.datetime(2000, 1, 1, tzinfo=dateutil.tz.tzutc())
+    window = new_window()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for n in xrange(size):
+        window.append(({'@timestamp': start + datetime.timedelta(milliseconds=n)}, n % 1000))
+    results.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+
+
+def measure(new_window, size):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=fill, args=(new_window, size, results))
+    process.start()
+    grown = results.get()
+    process.join()
+    return grown
+
+
+def main(size=1000000):
+    baseline = None
+    for name, new_window in windows():
+        # ru_maxrss is in kilobytes on Linux
+        grown = measure(new_window, size) * 1024.0
+        baseline = baseline or grown
+        print('%-20s %8d events  %6.1f bytes per event  %.1fx smaller' % (name, size, grown / size, baseline / grown))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
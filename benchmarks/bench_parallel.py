@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput of the percentile rule by number of worker processes.
+
+    python -m benchmarks.bench_parallel [documents] [query_keys] [workers ...]
+
+The parent extracts the fields and pickles every shard through a pipe, one
+after the other, so it bounds the speedup: its cost per document is reported
+as the parent overhead. Scaling needs at least as many free cores as workers.
+"""
+import cPickle
+import datetime
+import multiprocessing
+import os
+import sys
+import time
+
+if __name__ == '__main__' and not __package__:
+    # Run as python benchmarks/bench_parallel.py
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.generators import documents
+from benchmarks.generators import new_rule
+
+
+def timed(data, keys, workers, page=10000):
+    options = {'workers': workers} if workers > 1 else {'batch_ingest': True}
+    rule = new_rule('PercentileOfFieldSpikeRule', datetime.timedelta(seconds=30), keys=keys, **options)
+    start = time.time()
+    try:
+        for offset in xrange(0, len(data), page):
+            rule.add_data(data[offset:offset + page])
+    finally:
+        if rule.pool:
+            rule.pool.close()
+    return time.time() - start
+
+
+def parent_overhead(data, keys, page=10000):
+    """ Seconds the parent spends per document extracting and pickling the rows. """
+    rule = new_rule('PercentileOfFieldSpikeRule', datetime.timedelta(seconds=30), keys=keys)
+    start = time.time()
+    for offset in xrange(0, len(data), page):
+        timestamps, counts, keys, rows = rule.extract_columns(data[offset:offset + page])
+        cPickle.dumps([(row, timestamps[row], counts[row], keys[row]) for row in rows], cPickle.HIGHEST_PROTOCOL)
+    return (time.time() - start) / len(data)
+
+
+def main(size=100000, keys=1000, *workers):
+    workers = workers or (1, 2, 4, 8)
+    data = documents(size, keys)
+    print('%d cpus, parent overhead %.1f us/doc' % (multiprocessing.cpu_count(), parent_overhead(data, keys) * 1e6))
+
+    serial = None
+    for count in workers:
+        elapsed = timed(data, keys, count)
+        serial = serial or elapsed
+        print('workers %2d  %8.0f docs/s  speedup %.2fx' % (count, size / elapsed, serial / elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic access log documents and rule configurations for the benchmarks.
+"""
+import datetime
+import random
+
+import dateutil.tz
+
+from custom.ruletypes import PercentileOfFieldSpikeRule
+from examp.ruletypes import SumOfFieldFrequencyRule
+from examp.ruletypes import SumOfFieldSpikeRule
+
+START = datetime.datetime(2000, 1, 1, tzinfo=dateutil.tz.tzutc())
+
+RULE_TYPES = {'PercentileOfFieldSpikeRule': PercentileOfFieldSpikeRule,
+              'SumOfFieldSpikeRule': SumOfFieldSpikeRule,
+              'SumOfFieldFrequencyRule': SumOfFieldFrequencyRule}
+
+
+def documents(size, keys=1, rate=100, seed=0):
+    """ size documents, rate per second, spread over keys clientip values, with a
+    skewed time_taken like response times. """
+    rand = random.Random(seed)
+    step = datetime.timedelta(seconds=1.0 / rate)
+    return [{'@timestamp': START + step * n,
+             '_id': str(n),
+             'clientip': '10.%d.%d.%d' % (key >> 16 & 255, key >> 8 & 255, key & 255),
+             'time_taken': int(rand.lognormvariate(4, 1)) + 1}
+            for n, key in ((n, rand.randint(0, keys - 1)) for n in xrange(size))]
+
+
+def rule_options(rule_type, timeframe, percentile=90, keys=1, **kwargs):
+    rules = {'name': 'bench-%s' % (rule_type),
+             'type': rule_type,
+             'timeframe': timeframe,
+             'timestamp_field': '@timestamp',
+             'target_field': 'time_taken',
+             'buffer_time': datetime.timedelta(minutes=2)}
+    if rule_type == 'SumOfFieldFrequencyRule':
+        rules['num_events'] = 10 ** 9
+    else:
+        rules.update({'spike_height': 3, 'spike_type': 'up', 'threshold_cur': 10 ** 9})
+    if rule_type == 'PercentileOfFieldSpikeRule':
+        rules['percentile_value'] = percentile
+        if keys > 1:
+            rules['query_key'] = 'clientip'
+    rules.update(kwargs)
+    return rules
+
+
+def new_rule(rule_type, timeframe, percentile=90, keys=1, **kwargs):
+    return RULE_TYPES[rule_type](rule_options(rule_type, timeframe, percentile, keys, **kwargs))
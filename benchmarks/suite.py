@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput, latency and memory benchmarks of the custom rule types.
+
+    python -m benchmarks.suite [--quick] [--save-baseline FILE] [--baseline FILE]
+
+Every combination of --rules, --events, --keys, --timeframes and --percentiles
+is run in its own process. Each document goes through add_data on its own, so
+the per-event latency percentiles come from the same run as the throughput.
+With --baseline, the run fails when a case is slower, or uses more memory,
+than the saved one by more than --tolerance. benchmarks/baseline-quick.json
+holds the quick sweep of the reference machine, check a change against it with
+
+    python -m benchmarks.suite --quick --repeat 3 --baseline benchmarks/baseline-quick.json
+
+and save a new one with --save-baseline after intended changes, or on another
+machine, since throughput depends on the hardware.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import resource
+import sys
+import os
+import time
+
+if __name__ == '__main__' and not __package__:
+    # Run as python benchmarks/suite.py
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.generators import documents
+from benchmarks.generators import new_rule
+from benchmarks.generators import RULE_TYPES
+
+DEFAULTS = {'rules': sorted(RULE_TYPES),
+            'events': [1000, 10000, 100000, 1000000],
+            'keys': [1, 100, 10000],
+            'timeframes': [60, 3600],
+            'percentiles': [50, 99]}
+
+QUICK = {'rules': sorted(RULE_TYPES),
+         'events': [1000, 10000],
+         'keys': [1, 100],
+         'timeframes': [60],
+         'percentiles': [90]}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def run_case(case, results):
+    data = documents(case['events'], case['keys'])
+    rule = new_rule(case['rule'], datetime.timedelta(seconds=case['timeframe']), case['percentile'],
+                    case['keys'], **case.get('options', {}))
+
+    latencies = []
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    for document in data:
+        document_start = time.time()
+        rule.add_data([document])
+        latencies.append(time.time() - document_start)
+    elapsed = time.time() - start
+
+    results.put({'events_per_second': len(data) / elapsed,
+                 'latency_p50_us': percentile(latencies, 50) * 1e6,
+                 'latency_p99_us': percentile(latencies, 99) * 1e6,
+                 'latency_max_us': max(latencies) * 1e6,
+                 # ru_maxrss is in kilobytes on Linux
+                 'peak_memory_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024.0})
+
+
+def measure(case, repeat=1):
+    """ Run a case in a fresh process, so its peak memory is its own. With repeat,
+    the fastest of as many runs is kept, which is less noisy. """
+    best = None
+    for _ in xrange(repeat):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_case, args=(case, results))
+        process.start()
+        result = results.get()
+        process.join()
+        if best is None or result['events_per_second'] > best['events_per_second']:
+            best = result
+    return best
+
+
+def case_name(case):
+    name = '%(rule)s events=%(events)d keys=%(keys)d timeframe=%(timeframe)ds' % case
+    if case['rule'] == 'PercentileOfFieldSpikeRule':
+        name += ' p=%d' % (case['percentile'])
+    return name
+
+
+def cases(sweep):
+    seen = set()
+    for rule, events, keys, timeframe, p in itertools.product(
+            sweep['rules'], sweep['events'], sweep['keys'], sweep['timeframes'], sweep['percentiles']):
+        case = {'rule': rule, 'events': events, 'keys': keys, 'timeframe': timeframe, 'percentile': p}
+        # Only the percentile rule uses query_key and percentile_value
+        if rule != 'PercentileOfFieldSpikeRule':
+            case.update(keys=1, percentile=sweep['percentiles'][0])
+        if case_name(case) not in seen:
+            seen.add(case_name(case))
+            yield case
+
+
+def regressions(results, baseline, tolerance):
+    """ Messages for every case which got slower or bigger than the baseline allows. """
+    failures = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if result['events_per_second'] < expected['events_per_second'] * (1 - tolerance):
+            failures.append('%s: %.0f events/s, baseline %.0f' % (
+                name, result['events_per_second'], expected['events_per_second']))
+        # Small allocations are lost in the RSS granularity, only compare real growth
+        if result['peak_memory_mb'] > max(expected['peak_memory_mb'], 1) * (1 + tolerance):
+            failures.append('%s: %.1f MB peak memory, baseline %.1f MB' % (
+                name, result['peak_memory_mb'], expected['peak_memory_mb']))
+    return failures
+
+
+def report(name, result):
+    print('%-80s %9.0f ev/s  p50 %7.1fus  p99 %7.1fus  max %9.1fus  %7.1f MB' % (
+        name, result['events_per_second'], result['latency_p50_us'], result['latency_p99_us'],
+        result['latency_max_us'], result['peak_memory_mb']))
+    sys.stdout.flush()
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Benchmark the custom rule types')
+    parser.add_argument('--quick', action='store_true', help='Run a small sweep')
+    parser.add_argument('--rules', nargs='+', choices=sorted(RULE_TYPES))
+    parser.add_argument('--events', nargs='+', type=int)
+    parser.add_argument('--keys', nargs='+', type=int)
+    parser.add_argument('--timeframes', nargs='+', type=int, help='Timeframes in seconds')
+    parser.add_argument('--percentiles', nargs='+', type=int)
+    parser.add_argument('--save-baseline', dest='save_baseline', help='Write the results to this file')
+    parser.add_argument('--baseline', help='Fail on regressions against this file')
+    parser.add_argument('--repeat', type=int, default=1, help='Keep the fastest of this many runs of each case')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed relative slowdown or memory growth, default 0.25')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args if args is not None else sys.argv[1:])
+    sweep = dict(QUICK if args.quick else DEFAULTS)
+    for option in DEFAULTS:
+        if getattr(args, option):
+            sweep[option] = getattr(args, option)
+
+    results = {}
+    for case in cases(sweep):
+        results[case_name(case)] = measure(case, args.repeat)
+        report(case_name(case), results[case_name(case)])
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            failures = regressions(results, json.load(baseline_file), args.tolerance)
+        for failure in failures:
+            print('REGRESSION %s' % (failure))
+        if failures:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
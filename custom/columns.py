@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for the batch ingestion mode. The fields a rule needs are pulled out
+of a page of documents once, into columns, and rows are grouped by query_key
+so each group can be pushed into its windows in one go.
+
+NumPy is optional (pip install CustomRule[batch]); without it the same columns
+are built with plain lists.
+"""
+from custom.fields import field_getter
+from custom.fields import key_getter
+from custom.util import dt_to_epoch
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def extract(data, field):
+    """ Get the column of field values, None where the field is missing. """
+    get = field_getter(field)
+    return [get(document) for document in data]
+
+
+def extract_keys(data, query_key):
+    """ Get the column of hashable query_key values, None where the key is missing. """
+    get = key_getter(query_key)
+    return [get(document) for document in data]
+
+
+class Columns(object):
+    """ The columns of one page of documents, extracted on first use. Rules reading
+    the same page through a shared Columns (see custom.group) extract each field
+    once between them. """
+
+    def __init__(self, data):
+        self.data = data
+        self.cache = {}
+
+    def field(self, field):
+        if ('field', field) not in self.cache:
+            self.cache[('field', field)] = extract(self.data, field)
+        return self.cache[('field', field)]
+
+    def numbers(self, field):
+        """ Same as numeric_column of the field's column. """
+        if ('numbers', field) not in self.cache:
+            self.cache[('numbers', field)] = numeric_column(self.field(field))
+        return self.cache[('numbers', field)]
+
+    def keys(self, query_key):
+        if ('keys', query_key) not in self.cache:
+            self.cache[('keys', query_key)] = extract_keys(self.data, query_key)
+        return self.cache[('keys', query_key)]
+
+
+def numeric_column(values):
+    """ Get values as a NumPy array if they are all plain numbers, otherwise None. """
+    if np is None or not values:
+        return None
+    try:
+        column = np.asarray(values)
+    except (TypeError, ValueError):
+        return None
+    if column.ndim != 1 or column.dtype.kind not in 'iuf':
+        return None
+    return column
+
+
+def group_rows(keys, rows):
+    """ Group rows (indexes into keys) by their key. Returns a list of (key, rows)
+    ordered by first appearance, with rows kept in their original order. """
+    if not rows:
+        return []
+
+    codes = {}
+    row_codes = [codes.setdefault(keys[row], len(codes)) for row in rows]
+    by_code = [None] * len(codes)
+    for key, code in codes.iteritems():
+        by_code[code] = key
+
+    if np is None:
+        groups = [[] for _ in by_code]
+        for row, code in zip(rows, row_codes):
+            groups[code].append(row)
+        return zip(by_code, groups)
+
+    # Codes were handed out by first appearance, so a stable sort on them keeps
+    # both the group order and the row order inside each group
+    row_codes = np.asarray(row_codes, dtype=np.int64)
+    order = np.argsort(row_codes, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(row_codes[order])) + 1
+    groups = np.split(np.asarray(rows, dtype=np.int64)[order], bounds)
+    return [(key, group.tolist()) for key, group in zip(by_code, groups)]
+
+
+def coalesce(pairs, interval=None):
+    """ Group the counts of (timestamp, count) pairs sharing a timestamp or, with
+    interval, falling into the same interval. Each interval is represented by
+    the earliest timestamp seen in it, like the panes of PaneEventWindow.
+    Returns (timestamp, counts) in chronological order, counts in pair order. """
+    seconds = interval.total_seconds() if interval else 0
+    buckets = {}
+    for ts, count in pairs:
+        bucket = int(dt_to_epoch(ts) // seconds) if seconds else ts
+        if bucket in buckets:
+            earliest, counts = buckets[bucket]
+            counts.append(count)
+            if ts < earliest:
+                buckets[bucket] = (ts, counts)
+        else:
+            buckets[bucket] = (ts, [count])
+    return sorted(buckets.itervalues(), key=lambda group: group[0])
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Event window which keeps every event, like EventWindow, but as epoch timestamps
+and counts in parallel arrays of doubles instead of (dict, count) tuples. The
+event dicts are only rebuilt when a match needs one.
+"""
+import bisect
+import datetime
+from array import array
+
+from blist import sortedlist
+
+from custom.maxindex import MaxIndex
+from custom.util import dt_to_epoch
+from custom.util import epoch_to_dt
+
+# Expired entries are only cut off the front of the arrays once there are this many
+COMPACT_AFTER = 4096
+
+
+class CompactEventWindow(object):
+    """ A chronologically ordered window of (timestamp, count) pairs, mirroring the
+    EventWindow interface. With p_value None, count() is the sum of the counts.
+    Otherwise it is their p_value percentile, looked up in a value ordered index. """
+
+    def __init__(self, timeframe, onRemoved=None, ts_field='@timestamp', p_value=None):
+        self.timeframe = timeframe
+        self.span = timeframe.total_seconds()
+        self.onRemoved = onRemoved
+        self.ts_field = ts_field
+        self.p_value = p_value
+        self.tzinfo = None
+        self.clear()
+
+    def clear(self):
+        self.times = array('d')
+        self.counts = array('d')
+        self.start = 0
+        self.sum = 0
+        self.values = sortedlist() if self.p_value is not None else None
+        self.index = MaxIndex()
+        self.running_count = 0
+
+    def __len__(self):
+        return len(self.times) - self.start
+
+    def append(self, event):
+        """ Add an event to the window. Event should be of the form (dict, count).
+        This will also pop the oldest events and call onRemoved on them until the
+        window size is less than timeframe. """
+        ts = event[0][self.ts_field]
+        if not self:
+            self.tzinfo = ts.tzinfo
+        self.append_raw(dt_to_epoch(ts), event[1])
+
+    def extend(self, events):
+        """ Add several events, popping the oldest ones only once they are all in.
+        The window ends up the same as after appending them one by one. """
+        for event, count in events:
+            ts = event[self.ts_field]
+            if not self:
+                self.tzinfo = ts.tzinfo
+            self.add(dt_to_epoch(ts), count)
+        if self:
+            self.expire()
+
+    def append_raw(self, ts, count):
+        """ Add an epoch timestamp and count, e.g. expired from the current window. """
+        self.add(ts, count)
+        self.expire()
+
+    def add(self, ts, count):
+        count = float(count)
+        if not self or ts >= self.times[-1]:
+            self.times.append(ts)
+            self.counts.append(count)
+            self.index.append(count)
+        else:
+            # Late event, this should be rare as hits come sorted by timestamp
+            position = bisect.bisect_right(self.times, ts, self.start)
+            self.times.insert(position, ts)
+            self.counts.insert(position, count)
+            self.index.dirty = True
+        self.sum += count
+        if self.values is not None:
+            self.values.add(count)
+
+    def expire(self):
+        while self.times[-1] - self.times[self.start] >= self.span:
+            self.pop_oldest()
+
+    def pop_oldest(self):
+        ts = self.times[self.start]
+        count = self.counts[self.start]
+        self.start += 1
+        self.index.popleft()
+        self.sum -= count
+        if self.values is not None:
+            self.values.remove(count)
+
+        if self.start >= COMPACT_AFTER and self.start * 2 >= len(self.times):
+            del self.times[:self.start]
+            del self.counts[:self.start]
+            self.start = 0
+
+        self.onRemoved and self.onRemoved(ts, count)
+
+    def duration(self):
+        """ Get the size in timedelta of the window. """
+        if not self:
+            return datetime.timedelta(0)
+        return datetime.timedelta(seconds=self.times[-1] - self.times[self.start])
+
+    @property
+    def data(self):
+        """ (event, count) pairs in chronological order, building the event dicts on the fly. """
+        for position in xrange(self.start, len(self.times)):
+            yield {self.ts_field: epoch_to_dt(self.times[position], self.tzinfo)}, self.counts[position]
+
+    def find_first(self, count, strict=False):
+        """ Get the oldest (event, count) with at least count (more than count when
+        strict), or the newest one if there is none. """
+        if self.index.dirty:
+            self.index.rebuild(self.counts[self.start:])
+        position = self.index.find(count, strict)
+        position = len(self.times) - 1 if position is None else self.start + position
+        return {self.ts_field: epoch_to_dt(self.times[position], self.tzinfo)}, self.counts[position]
+
+    def entries(self):
+        """ (epoch, count, weight) triples of the window, for snapshots. """
+        for position in xrange(self.start, len(self.times)):
+            yield self.times[position], self.counts[position], 1
+
+    def count(self):
+        """ Get the sum, or the p_value percentile, of the counts in the window. """
+        if self.values is None:
+            self.running_count = self.sum
+        else:
+            self.running_count = self.percentile(self.p_value)
+        return self.running_count
+
+    def percentile(self, p_value):
+        """ Get any percentile of the counts, the window needs a p_value to keep them sorted. """
+        if not self.values:
+            return 0
+        p_posit = int(len(self.values) * p_value/100) - 1
+        return self.values[p_posit]
+
+    def __iter__(self):
+        return iter(self.data)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Suppression of documents a rule has already ingested, e.g. when overlapping
+queries over buffer_time return them again. The keys of the documents are
+remembered for a horizon of document time, so the memory used depends on the
+number of documents within that horizon only.
+"""
+import datetime
+from collections import deque
+
+from custom.fields import key_getter
+from custom.util import to_timedelta
+
+
+class DuplicateFilter(object):
+    """ Drops documents whose key was seen within horizon of the newest timestamp
+    seen so far. Documents without a key or a timestamp are always let through.
+    With max_keys, the oldest keys are forgotten early to stay within it. """
+
+    def __init__(self, get_key, get_timestamp, horizon, max_keys=None):
+        self.get_key = get_key
+        self.get_timestamp = get_timestamp
+        self.horizon = horizon
+        self.max_keys = max_keys
+        self.keys = set()
+        self.order = deque()
+        self.newest = None
+
+    def filter(self, data):
+        """ Get the documents of data which were not seen before, remembering them. """
+        new = []
+        keys = self.keys
+        for document in data:
+            key = self.get_key(document)
+            ts = self.get_timestamp(document)
+            if key is None or ts is None:
+                new.append(document)
+                continue
+            if key in keys:
+                continue
+
+            keys.add(key)
+            self.order.append((ts, key))
+            if self.newest is None or ts > self.newest:
+                self.newest = ts
+            new.append(document)
+
+        self.expire()
+        return new
+
+    def expire(self):
+        if not self.order:
+            return
+        oldest = self.newest - self.horizon
+        order = self.order
+        while order and (order[0][0] < oldest or (self.max_keys and len(order) > self.max_keys)):
+            self.keys.discard(order.popleft()[1])
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def duplicate_filter(rule):
+    """ The DuplicateFilter of a rule with dedupe_key set, otherwise None. The
+    horizon defaults to buffer_time plus query_delay, or timeframe. """
+    options = rule.rules
+    if not options.get('dedupe_key'):
+        return None
+    default = options.get('buffer_time', options['timeframe']) + options.get('query_delay', datetime.timedelta(0))
+    return DuplicateFilter(key_getter(options['dedupe_key']), rule.get_timestamp,
+                           to_timedelta(options.get('dedupe_horizon'), default), options.get('dedupe_max_keys'))
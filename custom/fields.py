@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Document field access for the custom rule types. The lookups of the fields a
+rule reads are compiled once, when the rule is created, and documents with
+missing or invalid fields are counted instead of logged one by one, then
+reported in a single summary line per run.
+"""
+import time
+
+from elastalert.ruletypes import hashable
+from elastalert.util import elastalert_logger
+from elastalert.util import lookup_es_key
+
+
+def field_getter(field):
+    """ Compile the lookup of field into a function of a document, giving the same
+    result as lookup_es_key. Plain nested dicts take a fast path, documents mixing
+    dotted keys and nesting fall back to lookup_es_key. """
+    if '.' not in field:
+        return lambda document: document.get(field)
+
+    subkeys = field.split('.')
+
+    def get(document):
+        if field in document:
+            return document[field]
+        value = document
+        for subkey in subkeys:
+            if not isinstance(value, dict) or subkey not in value:
+                return lookup_es_key(document, field)
+            value = value[subkey]
+        return value
+    return get
+
+
+def key_getter(query_key):
+    """ Same as field_getter, giving hashable query_key values. """
+    get = field_getter(query_key)
+    return lambda document: hashable(get(document))
+
+
+class FieldDiagnostics(object):
+    """ Counts the documents a rule could not use, by reason, and logs them as one
+    line at most every interval. """
+
+    def __init__(self, rule_name, interval):
+        self.rule_name = rule_name
+        self.interval = interval.total_seconds()
+        self.counts = {}
+        self.since = time.time()
+
+    def add(self, reason, field, documents=1):
+        """ Count documents e.g. 'without' field, the line is only formatted by report. """
+        key = (reason, field)
+        self.counts[key] = self.counts.get(key, 0) + documents
+
+    def report(self):
+        """ Log the counts if there are any and interval has passed, then reset them. """
+        now = time.time()
+        if not self.counts or now - self.since < self.interval:
+            return
+        elastalert_logger.warning('Rule %s found documents with missing or invalid fields in the last %d seconds: %s' % (
+            self.rule_name, now - self.since,
+            ', '.join('%d %s %s' % (count, reason, field) for (reason, field), count in sorted(self.counts.iteritems()))))
+        self.counts = {}
+        self.since = now
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Several rules evaluated over the hits of a single query. ElastAlert runs one
+query per rule file, so rules watching the same index each fetch and parse the
+same hits. A RuleGroup runs the query once and hands every page of hits, with
+its fields extracted into shared columns, to each of its member rules.
+"""
+import importlib
+
+from elastalert.ruletypes import RuleType
+from elastalert.util import EAException
+
+from custom import columns
+from custom.util import to_timedelta
+
+# Options of the group which only make sense for the group itself, or for one
+# rule at a time
+GROUP_OPTIONS = ('rules', 'name', 'type', 'rule_file', 'alert', 'match_enhancements', 'state_file', 'metrics_file')
+
+# Members share the group's query, so they can't change it
+QUERY_OPTIONS = ('index', 'filter', 'doc_type', 'use_count_query', 'use_terms_query',
+                 'use_percentile_aggregation', 'timestamp_field', 'timestamp_type')
+
+TIME_OPTIONS = ('timeframe', 'buffer_time', 'query_delay')
+
+
+def get_rule_type(name):
+    """ The rule type class at the dotted path name, e.g. custom.ruletypes.PercentileOfFieldSpikeRule. """
+    try:
+        module_path, class_name = name.rsplit('.', 1)
+        return getattr(importlib.import_module(module_path), class_name)
+    except (ImportError, AttributeError, ValueError) as e:
+        raise EAException('Could not import rule type %s: %s' % (name, e))
+
+
+def member_rules(group_rules, options):
+    """ Rule options of a member, the group's options overridden by its own. """
+    for option in QUERY_OPTIONS:
+        if option in options:
+            raise EAException('Rule group %s member %s can not set %s, members share the query of the group' % (
+                group_rules['name'], options.get('name'), option))
+    rules = dict((option, value) for option, value in group_rules.iteritems() if option not in GROUP_OPTIONS)
+    rules.update(options)
+    # ElastAlert only converts the options of the rule file itself
+    for option in TIME_OPTIONS:
+        if option in rules:
+            rules[option] = to_timedelta(rules[option])
+    return rules
+
+
+class RuleGroup(RuleType):
+    """ Runs the rules listed in the rules option on the hits of the group's query.
+    Members are PercentileOfFieldSpikeRule or SumOfFieldRuleFactory rules, each
+    with a name, a type and its own options, defaulting to the group's. Their
+    matches are alerted by the group, with rule_group_member set to the name of
+    the member which found them. """
+    required_options = frozenset(['rules'])
+
+    def __init__(self, *args):
+        super(RuleGroup, self).__init__(*args)
+        if not self.rules['rules']:
+            raise EAException('Rule group %s has no rules' % (self.rules['name']))
+
+        self.members = []
+        names = set()
+        for options in self.rules['rules']:
+            if 'name' not in options or 'type' not in options:
+                raise EAException('Every rule of rule group %s needs a name and a type' % (self.rules['name']))
+            if options['name'] in names:
+                raise EAException('Rule group %s has more than one rule named %s' % (
+                    self.rules['name'], options['name']))
+            names.add(options['name'])
+
+            rule_type = get_rule_type(options['type'])
+            # Only the column based rule types can read the shared columns, other
+            # rule types would also modify the documents they are given
+            if not hasattr(rule_type, 'add_batch'):
+                raise EAException('Rule group %s can not run %s, only PercentileOfFieldSpikeRule and '
+                                  'SumOfFieldRuleFactory rules' % (self.rules['name'], options['type']))
+            rules = member_rules(self.rules, options)
+            missing = rule_type.required_options - frozenset(rules.keys())
+            if missing:
+                raise EAException('Rule group %s member %s is missing required option(s): %s' % (
+                    self.rules['name'], options['name'], ', '.join(missing)))
+            self.members.append(rule_type(rules))
+
+    def add_data(self, data):
+        shared = columns.Columns(data)
+        for member in self.members:
+            member.add_data(data, shared)
+        self.collect_matches()
+
+    def garbage_collect(self, timestamp):
+        for member in self.members:
+            member.garbage_collect(timestamp)
+        self.collect_matches()
+
+    def collect_matches(self):
+        # The members already converted the matches with RuleType.add_match
+        for member in self.members:
+            for match in member.matches:
+                match['rule_group_member'] = member.rules['name']
+                self.matches.append(match)
+            member.matches = []
+
+    def member(self, name):
+        for member in self.members:
+            if member.rules['name'] == name:
+                return member
+        return None
+
+    def get_match_str(self, match):
+        member = self.member(match.get('rule_group_member'))
+        if member is None:
+            return ''
+        return 'Rule %s of %s\n%s' % (member.rules['name'], self.rules['name'], member.get_match_str(match))
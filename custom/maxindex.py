@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Index of the counts of a window, in chronological order, answering which is
+the first entry with at least (or more than) a given count in logarithmic time.
+This is the event a spike points to, so alerts don't need to scan the window.
+"""
+
+NEG = float('-inf')
+
+
+class MaxIndex(object):
+    """ Max segment tree over a sliding sequence of counts. Counts are appended at
+    the end and expire from the front, like the entries of a window. Expired
+    leaves are left in the tree and skipped by find, the tree is rebuilt when it
+    is full. An entry placed anywhere else (a late event) marks the index dirty:
+    it then ignores every change until the window rebuilds it from its counts,
+    before the next lookup. """
+
+    def __init__(self, counts=()):
+        self.rebuild(counts)
+
+    def rebuild(self, counts):
+        counts = list(counts)
+        self.size = 16
+        while self.size < len(counts) * 2:
+            self.size *= 2
+        self.tree = [NEG] * self.size + counts + [NEG] * (self.size - len(counts))
+        for node in xrange(self.size - 1, 0, -1):
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+        self.start = 0
+        self.end = len(counts)
+        self.dirty = False
+
+    def __len__(self):
+        return self.end - self.start
+
+    def append(self, count):
+        if self.dirty:
+            return
+        if self.end == self.size:
+            self.rebuild(self.tree[self.size + self.start:self.size + self.end])
+        self.end += 1
+        self.raise_last(count)
+
+    def raise_last(self, count):
+        """ Set the last count to count, which may not be lower than it was. """
+        if self.dirty:
+            return
+        tree = self.tree
+        node = self.size + self.end - 1
+        tree[node] = count
+        node >>= 1
+        while node and tree[node] < count:
+            tree[node] = count
+            node >>= 1
+
+    def popleft(self):
+        if self.dirty:
+            return
+        self.start += 1
+
+    def find(self, count, strict=False):
+        """ Position, from the oldest live entry, of the first entry with a count of at
+        least count (more than count when strict), or None. """
+        tree = self.tree
+        size = self.size
+        start = self.start
+        end = self.end
+
+        # Depth first, left to right, skipping subtrees out of [start, end) or
+        # whose max is too low
+        stack = [(1, 0, size)]
+        while stack:
+            node, low, high = stack.pop()
+            if high <= start or low >= end:
+                continue
+            value = tree[node]
+            if value < count or (strict and value == count):
+                continue
+            if node >= size:
+                return low - start
+            middle = (low + high) // 2
+            stack.append((2 * node + 1, middle, high))
+            stack.append((2 * node, low, middle))
+        return None
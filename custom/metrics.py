@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and stage timings of the custom rule types, readable as a dict and
+exportable in the Prometheus text format (e.g. for the node_exporter textfile
+collector). Recording a timing is a bisect and two additions, so the metrics
+are always collected.
+"""
+import bisect
+import os
+import time
+
+from elastalert.util import elastalert_logger
+
+from custom.compact import CompactEventWindow
+from custom.panes import PaneEventWindow
+
+# Upper bounds of the timing buckets, in seconds, from 1us to 1s
+BUCKETS = [10 ** (exponent / 2.0) / 1e6 for exponent in range(13)]
+STAGES = ('extract', 'append', 'count', 'match')
+COUNTERS = ('events_ingested', 'events_dropped', 'events_duplicate', 'events_coalesced', 'evaluations', 'matches')
+# Only the largest windows get a query_key labelled series in the text format
+EXPORTED_WINDOWS = 20
+
+
+class Timing(object):
+    """ Histogram of durations with fixed BUCKETS, plus their sum and number. """
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def cumulative(self):
+        """ (upper bound, observations up to it) pairs, ending with +Inf. """
+        seen = 0
+        for bound, observed in zip(BUCKETS + [float('inf')], self.buckets):
+            seen += observed
+            yield bound, seen
+
+    def stats(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'buckets': [(bound, seen) for bound, seen in self.cumulative()]}
+
+
+def window_size(window):
+    """ Number of entries kept by any of the window types: events, or panes. """
+    if isinstance(window, PaneEventWindow):
+        return len(window.panes)
+    if isinstance(window, CompactEventWindow):
+        return len(window)
+    return len(window.data)
+
+
+def rule_windows(rule):
+    """ The windows of a rule by query_key, as a list since a rule may keep two. """
+    if hasattr(rule, 'cur_windows'):
+        return dict((qk, [rule.ref_windows[qk], window]) for qk, window in rule.cur_windows.iteritems())
+    return dict((qk, [window]) for qk, window in getattr(rule, 'occurrences', {}).iteritems())
+
+
+def escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RuleMetrics(object):
+    """ Metrics of one rule. The counters and timings are recorded by the rule as
+    it goes, the window sizes and key count are read from it when asked for. """
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.counters = dict((counter, 0) for counter in COUNTERS)
+        self.timings = dict((stage, Timing()) for stage in STAGES)
+
+    def stats(self):
+        window_sizes = dict((qk, sum(window_size(window) for window in qk_windows))
+                            for qk, qk_windows in rule_windows(self.rule).iteritems())
+        stats = dict(self.counters)
+        evicted_keys = getattr(self.rule, 'evicted_keys', None)
+        if evicted_keys is not None:
+            stats['evicted_keys'] = dict(evicted_keys)
+
+        # In parallel mode the windows are kept by the workers, which report their
+        # own stats on garbage_collect. Their timings are left out.
+        for worker in getattr(self.rule, 'worker_stats', []):
+            for counter in COUNTERS:
+                stats[counter] += worker[counter]
+            for reason, evicted in worker['evicted_keys'].iteritems():
+                stats['evicted_keys'][reason] += evicted
+            window_sizes.update(worker['window_sizes'])
+
+        stats.update({'rule': self.rule.rules['name'],
+                      'query_keys': len(window_sizes),
+                      'window_sizes': window_sizes,
+                      'window_entries': sum(window_sizes.itervalues()),
+                      'timings': dict((stage, timing.stats()) for stage, timing in self.timings.iteritems())})
+        return stats
+
+    def prometheus(self):
+        """ The metrics in the Prometheus text exposition format. """
+        stats = self.stats()
+        rule = 'rule="%s"' % (escape(stats['rule']))
+        lines = []
+
+        for counter in COUNTERS:
+            lines.append('# TYPE elastalert_custom_%s_total counter' % (counter))
+            lines.append('elastalert_custom_%s_total{%s} %d' % (counter, rule, stats[counter]))
+        if 'evicted_keys' in stats:
+            lines.append('# TYPE elastalert_custom_evicted_keys_total counter')
+            for reason, evicted in sorted(stats['evicted_keys'].iteritems()):
+                lines.append('elastalert_custom_evicted_keys_total{%s,reason="%s"} %d' % (rule, reason, evicted))
+
+        lines.append('# TYPE elastalert_custom_query_keys gauge')
+        lines.append('elastalert_custom_query_keys{%s} %d' % (rule, stats['query_keys']))
+        lines.append('# TYPE elastalert_custom_window_entries gauge')
+        lines.append('elastalert_custom_window_entries{%s} %d' % (rule, stats['window_entries']))
+        largest = sorted(stats['window_sizes'].iteritems(), key=lambda item: item[1], reverse=True)
+        lines.append('# TYPE elastalert_custom_query_key_window_entries gauge')
+        for qk, size in largest[:EXPORTED_WINDOWS]:
+            lines.append('elastalert_custom_query_key_window_entries{%s,query_key="%s"} %d' % (rule, escape(qk), size))
+
+        lines.append('# TYPE elastalert_custom_stage_seconds histogram')
+        for stage in STAGES:
+            timing = self.timings[stage]
+            labels = '%s,stage="%s"' % (rule, stage)
+            for bound, seen in timing.cumulative():
+                bound = '+Inf' if bound == float('inf') else '%g' % bound
+                lines.append('elastalert_custom_stage_seconds_bucket{%s,le="%s"} %d' % (labels, bound, seen))
+            lines.append('elastalert_custom_stage_seconds_sum{%s} %r' % (labels, timing.sum))
+            lines.append('elastalert_custom_stage_seconds_count{%s} %d' % (labels, timing.count))
+        return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, metrics):
+    """ Atomically write the text format of a RuleMetrics to path. Each rule needs
+    its own file, as a metric family may only be described once per file. """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as metrics_file:
+        metrics_file.write(metrics.prometheus().encode('utf-8'))
+    os.rename(temp_path, path)
+
+
+class MetricsExporter(object):
+    """ Writes a rule's metrics file every interval, on its garbage_collect tick. """
+
+    def __init__(self, metrics, path, interval):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval.total_seconds()
+        self.written_at = 0
+
+    def tick(self):
+        if time.time() - self.written_at < self.interval:
+            return
+        try:
+            write_prometheus(self.path, self.metrics)
+        except (IOError, OSError) as e:
+            elastalert_logger.warning('Could not write metrics file %s: %s' % (self.path, e))
+        self.written_at = time.time()
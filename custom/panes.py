@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+Windows which pre-aggregate events into fixed time panes instead of keeping
+every event. Panes are expired whole as the window slides, so the memory used
+by a window depends on timeframe / resolution and not on the event rate.
+"""
+import datetime
+from collections import deque
+
+from blist import sortedlist
+
+from elastalert.ruletypes import new_get_event_ts
+
+from custom.maxindex import MaxIndex
+from custom.maxindex import NEG
+from custom.sketch import DDSketch
+from custom.util import dt_to_epoch
+
+
+# Tolerance on the weights of a Histogram, aggregation results spread documents
+# over the percentiles with fractional weights which don't subtract to exactly 0
+EPSILON = 1e-9
+
+
+def percentile_rank(count, p_value):
+    """ 0-based rank of the p_value percentile of count values. """
+    return int(count * p_value / 100.0 + EPSILON) - 1
+
+
+class Histogram(object):
+    """ Exact value histogram with the same interface as DDSketch.
+
+    value_at walks the sorted values from a cursor, a value and the total weight
+    of the values below it, which add and subtract keep up to date. Between two
+    evaluations of a sliding window the rank of a percentile moves by about the
+    number of documents added, so the walk is short instead of going over every
+    distinct value. One cursor is kept per percentile looked up. """
+
+    # Cursors further than count / CURSOR_SPACING from a rank get a new cursor
+    CURSOR_SPACING = 16
+    MAX_CURSORS = 8
+
+    def __init__(self):
+        self.bins = {}
+        self.keys = sortedlist()
+        self.count = 0
+        # [value, weight below value] pairs
+        self.cursors = []
+
+    def add(self, value, weight=1):
+        if value in self.bins:
+            self.bins[value] += weight
+        else:
+            self.bins[value] = weight
+            self.keys.add(value)
+        self.count += weight
+        for cursor in self.cursors:
+            if value < cursor[0]:
+                cursor[1] += weight
+
+    def merge(self, other):
+        for value, weight in other.bins.iteritems():
+            self.add(value, weight)
+
+    def subtract(self, other):
+        for value, weight in other.bins.iteritems():
+            self.count -= weight
+            for cursor in self.cursors:
+                if value < cursor[0]:
+                    cursor[1] -= weight
+
+            left = self.bins[value] - weight
+            if left > EPSILON:
+                self.bins[value] = left
+                continue
+            del self.bins[value]
+            position = self.keys.bisect_left(value)
+            self.keys.remove(value)
+            for cursor in self.cursors:
+                if cursor[0] == value:
+                    # Nothing below the cursor changed, move it to the next value
+                    cursor[0] = self.keys[position] if position < len(self.keys) else None
+            self.cursors = [cursor for cursor in self.cursors if cursor[0] is not None]
+
+        if not self.bins or self.count <= EPSILON:
+            self.count = 0
+            self.cursors = []
+
+    def cursor(self, rank):
+        """ The cursor closest to rank, creating one if they are all far from it. """
+        closest = None
+        for cursor in self.cursors:
+            if closest is None or abs(cursor[1] - rank) < abs(closest[1] - rank):
+                closest = cursor
+        if closest is not None and abs(closest[1] - rank) * self.CURSOR_SPACING <= self.count:
+            return closest
+        if len(self.cursors) >= self.MAX_CURSORS:
+            return closest
+        cursor = list(closest) if closest is not None else [self.keys[0], 0]
+        self.cursors.append(cursor)
+        return cursor
+
+    def value_at(self, rank):
+        """ Get the value at the given 0-based rank, negative ranks count from the largest value. """
+        if self.count <= EPSILON or not self.keys:
+            return 0
+        if rank < 0:
+            rank += self.count
+        # Weights may be off by rounding errors, ranks on a boundary between two
+        # values go to the higher one
+        rank = min(max(rank, 0), self.count - 1) + EPSILON
+
+        keys = self.keys
+        bins = self.bins
+        cursor = self.cursor(rank)
+        value, below = cursor
+        if below > rank:
+            position = keys.bisect_left(value)
+            while below > rank and position:
+                position -= 1
+                value = keys[position]
+                below -= bins[value]
+            if not position:
+                below = 0
+        elif below + bins[value] <= rank:
+            position = keys.bisect_left(value)
+            while below + bins[value] <= rank and position + 1 < len(keys):
+                below += bins[value]
+                position += 1
+                value = keys[position]
+        cursor[0] = value
+        cursor[1] = below
+        return value
+
+    def items(self):
+        return self.bins.iteritems()
+
+    def __len__(self):
+        return len(self.bins)
+
+
+class Pane(object):
+    """ The events of one resolution sized slice of time. Keeps the sum and number
+    of the counts, their distribution and the documents a match may point to:
+    the first one with a non-zero count and the one with the largest count. """
+    __slots__ = ('slot', 'sum', 'count', 'values', 'first', 'peak', 'event')
+
+    def __init__(self, slot, values):
+        self.slot = slot
+        self.sum = 0
+        self.count = 0
+        self.values = values
+        self.first = None
+        self.peak = None
+        self.event = None
+
+    def add(self, event, count, weight=1):
+        self.sum += count * weight
+        self.count += weight
+        if self.values is not None:
+            self.values.add(count, weight)
+        if count and self.first is None:
+            self.first = event
+        if self.peak is None or count > self.peak:
+            self.peak = count
+            self.event = event
+
+    def merge(self, other):
+        self.sum += other.sum
+        self.count += other.count
+        if self.values is not None:
+            self.values.merge(other.values)
+        if self.first is None:
+            self.first = other.first
+        if self.peak is None or other.peak > self.peak:
+            self.peak = other.peak
+            self.event = other.event
+
+
+class PaneEventWindow(object):
+    """ A sliding window of panes, mirroring the EventWindow interface.
+
+    With p_value None, count() is the sum of the counts like EventWindow.
+    Otherwise it is their p_value percentile, taken from an exact Histogram or,
+    when relative_error is given, from a DDSketch. The window keeps a running
+    sum and distribution which are updated as panes come in and expire, so the
+    cost of evaluating it does not depend on the number of events. """
+
+    def __init__(self, timeframe, onRemoved=None, getTimestamp=new_get_event_ts('@timestamp'), p_value=None,
+                 resolution=datetime.timedelta(seconds=1), relative_error=None, max_bins=2048):
+        self.timeframe = timeframe
+        self.onRemoved = onRemoved
+        self.get_ts = getTimestamp
+        self.p_value = p_value
+        self.resolution = resolution.total_seconds()
+        self.span = timeframe.total_seconds() / self.resolution
+        self.relative_error = relative_error
+        self.max_bins = max_bins
+        self.clear()
+
+    def clear(self):
+        self.panes = deque()
+        self.index = MaxIndex()
+        self.sum = 0
+        self.values = self.new_values(self.max_bins)
+        self.running_count = 0
+
+    def new_values(self, max_bins=None):
+        if self.p_value is None:
+            return None
+        if self.relative_error:
+            return DDSketch(self.relative_error, max_bins)
+        return Histogram()
+
+    def find_pane(self, slot):
+        """ Get the pane for slot, creating it in order if needed. """
+        if self.panes and self.panes[-1].slot == slot:
+            return self.panes[-1]
+        if not self.panes or self.panes[-1].slot < slot:
+            pane = Pane(slot, self.new_values())
+            self.panes.append(pane)
+            self.index.append(NEG)
+            return pane
+
+        # Late event, this should be rare as hits come sorted by timestamp
+        self.index.dirty = True
+        for position, pane in enumerate(self.panes):
+            if pane.slot == slot:
+                return pane
+            if pane.slot > slot:
+                pane = Pane(slot, self.new_values())
+                # deque has no insert before Python 3.5
+                self.panes.rotate(-position)
+                self.panes.appendleft(pane)
+                self.panes.rotate(position)
+                return pane
+
+    def append(self, event, weight=1):
+        """ Add an event to the window. Event should be of the form (dict, count).
+        This will also pop the oldest panes and call onRemoved on them until the
+        window size is less than timeframe. """
+        self.add(event, weight)
+        self.expire()
+
+    def extend(self, events):
+        """ Add several events, popping the oldest panes only once they are all in.
+        The window ends up the same as after appending them one by one. """
+        for event in events:
+            self.add(event)
+        self.expire()
+
+    def add(self, event, weight=1):
+        dct, count = event
+        slot = int(dt_to_epoch(self.get_ts(event)) // self.resolution)
+        pane = self.find_pane(slot)
+        pane.add(dct, count, weight)
+        self.update_index(pane)
+        self.sum += count * weight
+        if self.values is not None:
+            self.values.add(count, weight)
+
+    def append_pane(self, pane):
+        """ Add a whole pane, e.g. one expired from the current window. """
+        if self.panes and self.panes[-1].slot >= pane.slot:
+            merged = self.find_pane(pane.slot)
+            merged.merge(pane)
+            self.update_index(merged)
+        else:
+            self.panes.append(pane)
+            self.index.append(self.pane_count(pane))
+        self.sum += pane.sum
+        if self.values is not None:
+            self.values.merge(pane.values)
+        self.expire()
+
+    def expire(self):
+        while self.duration() >= self.span:
+            oldest = self.panes.popleft()
+            self.index.popleft()
+            self.sum -= oldest.sum
+            if self.values is not None:
+                self.values.subtract(oldest.values)
+            self.onRemoved and self.onRemoved(oldest)
+
+    def pane_count(self, pane):
+        """ The count of a pane in data. """
+        return pane.sum if self.p_value is None else pane.peak
+
+    def update_index(self, pane):
+        """ Update the index after pane was added to, which only raises its count. """
+        if pane is self.panes[-1]:
+            self.index.raise_last(self.pane_count(pane))
+        else:
+            self.index.dirty = True
+
+    def find_first(self, count, strict=False):
+        """ Get the oldest (event, count) pair of data with at least count (more than
+        count when strict), or the newest one if there is none. """
+        if self.index.dirty:
+            self.index.rebuild(self.pane_count(pane) for pane in self.panes)
+        position = self.index.find(count, strict)
+        pane = self.panes[-1 if position is None else position]
+        if self.p_value is None:
+            return pane.first, pane.sum
+        return pane.event, pane.peak
+
+    def duration(self):
+        """ Get the size of the window in panes. """
+        if not self.panes:
+            return 0
+        return self.panes[-1].slot - self.panes[0].slot
+
+    @property
+    def data(self):
+        """ Pairs of (event, count) in chronological order, one per pane. For sums
+        this is the first non-zero event and the pane sum, for percentiles the
+        event with the largest count. """
+        if self.p_value is None:
+            return [(pane.first, pane.sum) for pane in self.panes]
+        return [(pane.event, pane.peak) for pane in self.panes]
+
+    def entries(self):
+        """ (epoch, count, weight) triples summarizing the window, for snapshots.
+        Each pane gives its sum, or its distribution, at the start of the pane. """
+        for pane in self.panes:
+            ts = pane.slot * self.resolution
+            if pane.values is None:
+                yield ts, pane.sum, 1
+            else:
+                for count, weight in pane.values.items():
+                    yield ts, count, weight
+
+    def count(self):
+        """ Get the sum, or the p_value percentile, of the counts in the window. """
+        if self.p_value is None:
+            self.running_count = self.sum
+        else:
+            self.running_count = self.percentile(self.p_value)
+        return self.running_count
+
+    def percentile(self, p_value):
+        """ Get any percentile of the counts, the window needs a p_value to keep their distribution. """
+        return self.values.value_at(percentile_rank(self.values.count, p_value))
+
+    def __iter__(self):
+        return iter(self.data)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel mode of PercentileOfFieldSpikeRule. The windows of each query_key are
+independent, so query_keys are hash partitioned over worker processes, each of
+them running its own copy of the rule on the keys of its shard. The parent only
+extracts the fields, sends every worker the rows of its keys and puts the
+matches coming back in the order of the documents which triggered them.
+"""
+import multiprocessing
+
+from elastalert.util import EAException
+
+# Options the parent takes care of
+PARENT_OPTIONS = ('workers', 'metrics_file')
+
+
+class WorkerError(EAException):
+    """ A worker process stopped, the pool has been torn down. """
+
+
+def shard_rules(rules, workers):
+    """ Rule options of a worker's copy of the rule. """
+    rules = dict((option, value) for option, value in rules.iteritems() if option not in PARENT_OPTIONS)
+    if rules.get('max_query_keys'):
+        rules['max_query_keys'] = -(-rules['max_query_keys'] // workers)
+    return rules
+
+
+def serve(rule_type, rules, connection):
+    """ Worker loop, running the shard's rule until told to stop. """
+    rule = rule_type(rules)
+    ts_field = rule.ts_field
+    while True:
+        command, argument = connection.recv()
+        if command == 'events':
+            # (row, timestamp, count, query_key) of the documents of this shard
+            matches = []
+            for row, ts, count, qk in argument:
+                rule.handle_event({ts_field: ts}, count, qk)
+                if rule.matches:
+                    matches.extend((row, match) for match in rule.matches)
+                    rule.matches = []
+            connection.send(matches)
+        elif command == 'garbage_collect':
+            rule.garbage_collect(argument)
+            connection.send(rule.metrics.stats())
+        else:
+            connection.close()
+            return
+
+
+class ShardPool(object):
+    """ Worker processes owning the windows of a rule, started on first use. """
+
+    def __init__(self, rule, workers):
+        for option in ('alert_on_new_data', 'state_file', 'use_percentile_aggregation'):
+            if rule.rules.get(option):
+                raise EAException('workers can not be used with %s' % (option))
+        if 'query_key' not in rule.rules:
+            raise EAException('workers needs a query_key to split the windows on')
+
+        self.rule = rule
+        self.workers = workers
+        self.connections = []
+        self.processes = []
+
+    def start(self):
+        rules = shard_rules(self.rule.rules, self.workers)
+        for _ in xrange(self.workers):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=serve, args=(type(self.rule), rules, child))
+            process.daemon = True
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+
+    def shard(self, qk):
+        return hash(qk) % self.workers
+
+    def handle(self, rows):
+        """ Send (row, timestamp, count, query_key) rows to the workers owning their
+        query_keys, all of them working at once. Returns the new matches in row order. """
+        if not self.processes:
+            self.start()
+
+        shards = [[] for _ in xrange(self.workers)]
+        for row in rows:
+            shards[self.shard(row[3])].append(row)
+
+        busy = [connection for connection, shard in zip(self.connections, shards) if shard]
+        matches = []
+        try:
+            for connection, shard in zip(self.connections, shards):
+                if shard:
+                    connection.send(('events', shard))
+            for connection in busy:
+                matches.extend(connection.recv())
+        except (EOFError, IOError, OSError) as e:
+            self.terminate()
+            raise WorkerError('A worker process of rule %s stopped: %r' % (self.rule.rules['name'], e))
+        matches.sort(key=lambda match: match[0])
+        return [match for _, match in matches]
+
+    def garbage_collect(self, ts):
+        """ Run garbage_collect in every worker, returning their metrics stats. """
+        if not self.processes:
+            return []
+        try:
+            for connection in self.connections:
+                connection.send(('garbage_collect', ts))
+            return [connection.recv() for connection in self.connections]
+        except (EOFError, IOError, OSError) as e:
+            self.terminate()
+            raise WorkerError('A worker process of rule %s stopped: %r' % (self.rule.rules['name'], e))
+
+    def terminate(self):
+        """ Stop every worker without waiting for them, e.g. once one of them died. """
+        for connection, process in zip(self.connections, self.processes):
+            connection.close()
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        self.connections = []
+        self.processes = []
+
+    def close(self):
+        for connection, process in zip(self.connections, self.processes):
+            connection.send(('stop', None))
+            connection.close()
+            process.join()
+        self.connections = []
+        self.processes = []
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Offline replay of recorded hits through a rule, to tune its options without
+deploying it or querying Elasticsearch.
+
+    python -m custom.replay RULE_FILE HITS_FILE [HITS_FILE ...] [--set OPTION=VALUE]
+
+Each HITS_FILE holds one document, or one Elasticsearch hit with a _source,
+per line (NDJSON). Files ending in .gz are decompressed on the fly, - reads
+stdin, other files are memory mapped. Hits should be sorted by timestamp, as
+ElastAlert's queries return them. They are fed to the rule's add_data in
+batches of --batch-size, then the matches are printed with the throughput and
+peak memory of the run.
+"""
+import argparse
+import gzip
+import io
+import itertools
+import json
+import mmap
+import os
+import resource
+import sys
+import time
+from contextlib import closing
+
+import yaml
+
+from elastalert.util import EAException
+from elastalert.util import set_es_key
+from elastalert.util import ts_to_dt
+
+from custom.fields import field_getter
+from custom.util import iso_to_dt
+
+# Options writing files next to a deployed rule, a replay must not touch them
+DEPLOYMENT_OPTIONS = ('state_file', 'metrics_file')
+
+
+def read_lines(path):
+    """ Lines of path, without reading the whole file into memory. """
+    if path == '-':
+        return iter(sys.stdin)
+    if path.endswith('.gz'):
+        return gzip_lines(path)
+    return mapped_lines(path)
+
+
+def gzip_lines(path):
+    with closing(gzip.open(path, 'rb')) as compressed:
+        for line in io.BufferedReader(compressed):
+            yield line
+
+
+def mapped_lines(path):
+    with open(path, 'rb') as f:
+        # Empty files can't be mapped
+        if not os.fstat(f.fileno()).st_size:
+            return
+        with closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as mapped:
+            for line in iter(mapped.readline, ''):
+                yield line
+
+
+def cached(convert, size=10000):
+    """ Memoize convert, many documents share the same timestamp string. """
+    cache = {}
+
+    def get(value):
+        if value not in cache:
+            if len(cache) >= size:
+                cache.clear()
+            cache[value] = convert(value)
+        return cache[value]
+    return get
+
+
+def read_hits(paths, ts_field='@timestamp', convert=ts_to_dt):
+    """ Documents of the NDJSON files in paths, with their ts_field turned into a
+    datetime by convert like ElastAlert does with the hits of its queries. """
+    get_timestamp = field_getter(ts_field)
+    if convert is ts_to_dt:
+        convert = iso_to_dt
+    convert = cached(convert)
+    for path in paths:
+        for number, line in enumerate(read_lines(path), 1):
+            if not line.strip():
+                continue
+            try:
+                document = json.loads(line)
+            except ValueError as e:
+                raise EAException('%s:%d is not valid JSON: %s' % (path, number, e))
+
+            if '_source' in document:
+                hit = document
+                document = hit['_source']
+                for field in ('_id', '_index', '_type'):
+                    if field in hit:
+                        document[field] = hit[field]
+
+            ts = get_timestamp(document)
+            if ts is not None:
+                set_es_key(document, ts_field, convert(ts))
+            yield document
+
+
+def batches(documents, size):
+    documents = iter(documents)
+    while True:
+        batch = list(itertools.islice(documents, size))
+        if not batch:
+            return
+        yield batch
+
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def replay(rule, documents, batch_size=10000, on_match=None):
+    """ Feed documents to rule in batches, calling on_match with every match and
+    garbage_collect with the newest timestamp after each batch, like a run of
+    ElastAlert. Returns the statistics of the replay. """
+    get_timestamp = field_getter(rule.rules['timestamp_field'])
+    count = 0
+    matches = 0
+    newest = None
+    start = time.time()
+    for batch in batches(documents, batch_size):
+        rule.add_data(batch)
+        count += len(batch)
+        for document in batch:
+            ts = get_timestamp(document)
+            if ts is not None and (newest is None or ts > newest):
+                newest = ts
+
+        if newest is not None:
+            rule.garbage_collect(newest)
+        matches += len(rule.matches)
+        if on_match is not None:
+            for match in rule.matches:
+                on_match(match)
+        rule.matches = []
+
+    elapsed = time.time() - start
+    return {'documents': count,
+            'matches': matches,
+            'seconds': elapsed,
+            'events_per_second': count / elapsed if elapsed else 0,
+            'peak_memory_mb': peak_memory_mb()}
+
+
+def parse_override(override):
+    """ OPTION=VALUE, the value is parsed as YAML like the rule file, e.g.
+    spike_height=3 or 'timeframe={minutes: 5}'. """
+    if '=' not in override:
+        raise EAException('%s should be of the form OPTION=VALUE' % (override))
+    option, value = override.split('=', 1)
+    return option.strip(), yaml.safe_load(value)
+
+
+def load_rule(filename, overrides=()):
+    """ Instantiate the rule type of a rule file, with overrides applied before its
+    options are loaded. Alerts are not loaded, matches are only reported. """
+    # elastalert.config imports every alerter, only pay for it when loading a file
+    from elastalert.config import get_module
+    from elastalert.config import load_options
+    from elastalert.config import load_rule_yaml
+    from elastalert.config import rules_mapping
+
+    rules = load_rule_yaml(filename)
+    rules.update(overrides)
+    for option in DEPLOYMENT_OPTIONS:
+        rules.pop(option, None)
+    load_options(rules, {}, filename)
+
+    if rules['type'] in rules_mapping:
+        rule_type = rules_mapping[rules['type']]
+    else:
+        rule_type = get_module(rules['type'])
+    missing = rule_type.required_options - frozenset(rules.keys())
+    if missing:
+        raise EAException('Missing required option(s): %s' % (', '.join(missing)))
+    return rule_type(rules)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Replay recorded hits through a rule.')
+    parser.add_argument('rule', help='Rule file')
+    parser.add_argument('hits', nargs='+', help='NDJSON files of hits, .gz compressed or - for stdin')
+    parser.add_argument('--set', action='append', default=[], dest='overrides', metavar='OPTION=VALUE',
+                        help='Override a rule option, the value is YAML')
+    parser.add_argument('--batch-size', type=int, default=10000, help='Documents per add_data call')
+    parser.add_argument('--json', action='store_true', help='Print matches as NDJSON instead of alert text')
+    parser.add_argument('--quiet', action='store_true', help='Only print the summary')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rule = load_rule(args.rule, [parse_override(override) for override in args.overrides])
+
+    def on_match(match):
+        if args.quiet:
+            return
+        if args.json:
+            print(json.dumps(match, default=str, sort_keys=True))
+        else:
+            print(rule.get_match_str(match))
+
+    documents = read_hits(args.hits, rule.rules['timestamp_field'], rule.rules['ts_to_dt'])
+    stats = replay(rule, documents, args.batch_size, on_match)
+    sys.stderr.write('%(documents)d documents, %(matches)d matches in %(seconds).1fs: '
+                     '%(events_per_second).0f events/s, %(peak_memory_mb).1f MB peak memory\n' % stats)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,6 +8,9 @@ discarded (i.e. use_count_query would have sufficed), as it does not
 preserve them.
 """
 import copy
+import datetime
+import time
+from collections import OrderedDict
 
 import threading
 
@@ -18,9 +21,56 @@ from elastalert.ruletypes import hashable
 from elastalert.ruletypes import new_get_event_ts
 from elastalert.ruletypes import SpikeRule
 from elastalert.ruletypes import EventWindow
-from elastalert.util import lookup_es_key
 from elastalert.util import elastalert_logger
 from elastalert.util import pretty_ts
+from elastalert.util import EAException
+from elastalert.util import ts_to_dt
+
+from custom import columns
+from custom import snapshot
+from custom.compact import CompactEventWindow
+from custom.dedupe import duplicate_filter
+from custom.fields import field_getter
+from custom.fields import key_getter
+from custom.fields import FieldDiagnostics
+from custom.maxindex import MaxIndex
+from custom.metrics import MetricsExporter
+from custom.metrics import RuleMetrics
+from custom.metrics import window_size
+from custom.panes import PaneEventWindow
+from custom.parallel import ShardPool
+from custom.parallel import WorkerError
+from custom.util import to_timedelta
+
+
+DEFAULT_AGGREGATION_PERCENTS = [1, 5, 10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 99]
+
+
+def interval_period(interval):
+    """ Elasticsearch date_histogram interval of a timedelta, in seconds when it is
+    a whole number of them, otherwise in milliseconds. """
+    milliseconds = interval.total_seconds() * 1000
+    if milliseconds < 1 or milliseconds != int(milliseconds):
+        raise EAException('bucket_interval must be a positive whole number of milliseconds, got %s' % (interval))
+    if milliseconds % 1000:
+        return '%dms' % (milliseconds)
+    return '%ds' % (milliseconds / 1000)
+
+
+def percentile_distribution(doc_count, values):
+    """ Turn the result of a percentiles aggregation into (value, weight) pairs:
+    each value stands for the documents between the midpoints to its neighbour
+    percents, so the weights add up to doc_count. """
+    points = sorted((float(percent), value) for percent, value in values.iteritems() if value is not None)
+    if not doc_count or not points:
+        return []
+
+    distribution = []
+    for n, (percent, value) in enumerate(points):
+        low = (points[n - 1][0] + percent) / 2 if n else 0.0
+        high = (points[n + 1][0] + percent) / 2 if n + 1 < len(points) else 100.0
+        distribution.append((value, doc_count * (high - low) / 100))
+    return distribution
 
 
 class PercentileOfFieldSpikeRule(SpikeRule):
@@ -30,6 +80,62 @@ class PercentileOfFieldSpikeRule(SpikeRule):
 
         self.skip_test = {}
 
+        # Every percentile is looked up in the same windows, with its own thresholds
+        percentile_value = self.rules['percentile_value']
+        self.percentiles = list(percentile_value) if isinstance(percentile_value, (list, tuple)) else [percentile_value]
+        self.thresholds = dict((percentile, {'spike_height': self.percentile_option('spike_height', percentile),
+                                             'threshold_cur': self.percentile_option('threshold_cur', percentile, 0),
+                                             'threshold_ref': self.percentile_option('threshold_ref', percentile, 0)})
+                               for percentile in self.percentiles)
+
+        self.percentile_mode = self.rules.get('percentile_mode', 'exact')
+        if self.percentile_mode not in ('exact', 'approximate'):
+            raise EAException('percentile_mode must be one of exact or approximate')
+        needs_panes = self.percentile_mode == 'approximate' or self.rules.get('use_percentile_aggregation')
+        self.window_mode = self.rules.get('window_mode', 'pane' if needs_panes else 'event')
+        if self.window_mode not in ('event', 'compact', 'pane'):
+            raise EAException('window_mode must be one of event, compact or pane')
+        if needs_panes and self.window_mode != 'pane':
+            raise EAException('percentile_mode approximate and use_percentile_aggregation require window_mode pane')
+        self.window_resolution = to_timedelta(self.rules.get('window_resolution'), datetime.timedelta(seconds=1))
+
+        if self.rules.get('use_percentile_aggregation'):
+            # ElastAlert wraps aggregation_query_element in a date_histogram of
+            # bucket_interval_period, itself in a terms aggregation on query_key
+            bucket_interval = to_timedelta(self.rules.get('bucket_interval'), self.window_resolution)
+            self.rules['bucket_interval_period'] = interval_period(bucket_interval)
+            self.rules['aggregation_query_element'] = self.generate_aggregation_query()
+
+        self.get_timestamp = field_getter(self.ts_field)
+        self.get_target = field_getter(self.rules['target_field'])
+        self.get_query_key = key_getter(self.rules['query_key']) if 'query_key' in self.rules else None
+        self.diagnostics = FieldDiagnostics(self.rules['name'], to_timedelta(
+            self.rules.get('diagnostics_interval'), datetime.timedelta(minutes=1)))
+        self.duplicates = duplicate_filter(self)
+
+        # Newest event timestamp per query_key, least recently seen first
+        self.last_seen = OrderedDict()
+        self.max_query_keys = self.rules.get('max_query_keys')
+        self.evicted_keys = {'idle': 0, 'max_query_keys': 0}
+
+        self.metrics = RuleMetrics(self)
+        self.metrics_exporter = None
+        if self.rules.get('metrics_file'):
+            self.metrics_exporter = MetricsExporter(self.metrics, self.rules['metrics_file'], to_timedelta(
+                self.rules.get('metrics_interval'), datetime.timedelta(minutes=1)))
+
+        # Windows are kept by worker processes instead, see custom.parallel
+        self.pool = None
+        self.worker_stats = []
+        if self.rules.get('workers', 1) > 1:
+            self.pool = ShardPool(self, self.rules['workers'])
+
+        self.checkpointer = None
+        if self.rules.get('state_file'):
+            snapshot.load(self, self.rules['state_file'])
+            self.checkpointer = snapshot.Checkpointer(self, self.rules['state_file'], to_timedelta(
+                self.rules.get('state_checkpoint_interval'), datetime.timedelta(minutes=1)))
+
     """
     Metaclass that creates a subclass of the class's backing_rule_type.
     backing_rule_type must implement add_count_data.
@@ -40,37 +146,260 @@ class PercentileOfFieldSpikeRule(SpikeRule):
 
     required_options = frozenset(['percentile_value', 'target_field'])
 
-    def add_data(self, data):
+    def add_data(self, data, shared=None):
+        # shared is the columns.Columns of data when the rule is part of a RuleGroup
+        if self.duplicates is not None:
+            new_data = self.duplicates.filter(data)
+            self.metrics.counters['events_duplicate'] += len(data) - len(new_data)
+            if len(new_data) < len(data):
+                shared = None
+            data = new_data
+
+        if self.pool:
+            return self.add_parallel(data, shared)
+        if self.rules.get('batch_ingest') or shared is not None:
+            return self.add_batch(data, shared)
+
+        extract_timing = self.metrics.timings['extract']
+        get_query_key = self.get_query_key
         for document in data:
+            start = time.time()
 
-            qk = self.rules.get('query_key', 'all')
+            qk = 'all'
 
-            if qk != 'all':
-                qk = hashable(lookup_es_key(document, qk))
+            if get_query_key:
+                qk = get_query_key(document)
                 if qk is None:
-                    elastalert_logger.warning("Didn't find Qk in document.")
+                    self.diagnostics.add('without query_key', self.rules['query_key'])
                     qk = 'other'
             
             # has to @timestamp
-            ts = lookup_es_key(document, self.ts_field)
+            ts = self.get_timestamp(document)
             # has to be integer
-            count = lookup_es_key(document, self.rules['target_field'])
+            count = self.get_target(document)
             
             if count and ts:
+                extract_timing.observe(time.time() - start)
                 self.handle_event({self.ts_field: ts}, count, qk)
             else:
-                elastalert_logger.warning(
-                    'Did not find field %s representing target_field in '
-                    'document for rule %s' % ( self.rules['target_field'], self.rules['name']))
+                self.metrics.counters['events_dropped'] += 1
+                self.count_missing(ts, count)
+
+    def add_batch(self, data, shared=None):
+        """ Same as add_data, but the fields are extracted into columns once and the
+        documents are handled grouped by query_key. Matches are put back in the
+        order of the documents which triggered them. """
+        self.handle_rows(*self.extract_columns(data, shared))
+
+    def handle_rows(self, timestamps, counts, keys, rows):
+        """ Handle the rows of the columns given by extract_columns. """
+        ts_field = self.ts_field
+        if keys is not None and (self.rules.get('alert_on_new_data') or self.max_query_keys):
+            # ref_window_filled_once is shared by all keys with alert_on_new_data,
+            # and max_query_keys evicts the least recently seen keys, so the
+            # documents have to be handled in their original order
+            for row in rows:
+                self.handle_event({ts_field: timestamps[row]}, counts[row], keys[row])
+            return
 
-    def handle_event(self, event, count, qk='all'):
+        groups = [('all', rows)] if keys is None else columns.group_rows(keys, rows)
+        first_match = len(self.matches)
+        match_rows = []
+        for qk, group in groups:
+            events = [({ts_field: timestamps[row]}, counts[row]) for row in group]
+            match_rows.extend(group[position] for position in self.handle_events(events, qk))
+
+        if len(match_rows) > 1:
+            new_matches = sorted(zip(match_rows, self.matches[first_match:]), key=lambda match: match[0])
+            self.matches[first_match:] = [match for _, match in new_matches]
+
+    def add_parallel(self, data, shared=None):
+        """ Same as add_batch, but the documents are handled by the worker processes
+        owning their query_keys. """
+        timestamps, counts, keys, rows = self.extract_columns(data, shared)
+        try:
+            self.matches.extend(self.pool.handle([(row, timestamps[row], counts[row], keys[row]) for row in rows]))
+        except WorkerError as e:
+            self.stop_workers(e)
+            self.handle_rows(timestamps, counts, keys, rows)
+
+    def stop_workers(self, error):
+        """ Continue without the worker processes, their windows are lost so the
+        rule starts over like after a restart. """
+        elastalert_logger.error('%s, rule %s continues without workers' % (error, self.rules['name']))
+        self.pool = None
+        self.worker_stats = []
+
+    def extract_columns(self, data, shared=None):
+        """ Get the timestamp, count and query_key columns of data (keys is None
+        without query_key) and the rows which have both a timestamp and a count.
+        The columns are taken from shared when given. """
+        start = time.time()
+        if shared is None:
+            shared = columns.Columns(data)
+        timestamps = shared.field(self.ts_field)
+        numeric = shared.numbers(self.rules['target_field'])
+        if numeric is not None:
+            counts = numeric.tolist()
+        else:
+            counts = shared.field(self.rules['target_field'])
+
+        rows = [row for row in xrange(len(data)) if counts[row] and timestamps[row]]
+        if len(rows) < len(data):
+            self.metrics.counters['events_dropped'] += len(data) - len(rows)
+            for row in xrange(len(data)):
+                if not (counts[row] and timestamps[row]):
+                    self.count_missing(timestamps[row], counts[row])
+
+        keys = None
+        if self.get_query_key:
+            keys = shared.keys(self.rules['query_key'])
+            missing = sum(1 for row in rows if keys[row] is None)
+            if missing:
+                self.diagnostics.add('without query_key', self.rules['query_key'], missing)
+                keys = [key if key is not None else 'other' for key in keys]
+
+        self.metrics.timings['extract'].observe(time.time() - start)
+        return timestamps, counts, keys, rows
+
+    def count_missing(self, ts, count):
+        """ Count a document which can't be used, by the first field it lacks. """
+        if not ts:
+            self.diagnostics.add('without', self.ts_field)
+        elif count is None:
+            self.diagnostics.add('without', self.rules['target_field'])
+        else:
+            self.diagnostics.add('with a zero', self.rules['target_field'])
+
+    def generate_aggregation_query(self):
+        percents = set(self.rules.get('aggregation_percents', DEFAULT_AGGREGATION_PERCENTS))
+        percents.update(self.percentiles)
+        percentiles = {'field': self.rules['target_field'], 'percents': sorted(percents)}
+        if 'aggregation_compression' in self.rules:
+            percentiles['tdigest'] = {'compression': self.rules['aggregation_compression']}
+        return {'target_percentiles': {'percentiles': percentiles}}
+
+    def add_aggregation_data(self, payload):
+        """ Add the per interval percentiles computed by Elasticsearch. Each interval
+        is added to the windows as a distribution of its doc_count documents over
+        the returned percentiles, then the windows are checked once. """
+        for timestamp, payload_data in payload.iteritems():
+            if 'bucket_aggs' in payload_data:
+                for term_data in payload_data['bucket_aggs']['buckets']:
+                    self.add_interval_buckets(hashable(term_data['key']), term_data['interval_aggs']['buckets'])
+            elif 'interval_aggs' in payload_data:
+                self.add_interval_buckets('all', payload_data['interval_aggs']['buckets'])
+
+    def add_interval_buckets(self, qk, interval_buckets):
+        for interval_data in interval_buckets:
+            distribution = percentile_distribution(
+                interval_data['doc_count'], interval_data['target_percentiles']['values'])
+            if not distribution:
+                continue
+
+            event = {self.ts_field: ts_to_dt(interval_data['key_as_string'])}
+            if qk != 'all':
+                event[self.rules['query_key']] = qk
+            for count, weight in distribution:
+                self.append_event(event, count, qk, weight)
+            self.check_windows(event, qk)
 
+    def handle_event(self, event, count, qk='all'):
+        self.append_event(event, count, qk)
+        self.check_windows(event, qk)
+
+    def handle_events(self, events, qk='all'):
+        """ handle_event for each (event, count) of events, in order. Runs of events
+        after which the windows are not compared, or their percentiles can't reach
+        threshold_cur, are appended in one go. Returns the positions in events of
+        the events which matched. """
+        ts_field = self.ts_field
+        filling = self.rules['timeframe'] * 2
+        new_data_alerts = self.rules.get('query_key') and self.rules.get('alert_on_new_data')
+        # Percentiles are counts of the window, except for the approximate ones
+        threshold = None
+        if self.percentile_mode == 'exact':
+            threshold = min(thresholds['threshold_cur'] for thresholds in self.thresholds.itervalues())
+
+        matched = []
+        run = []
+        for position, (event, count) in enumerate(events):
+            if not run:
+                first = self.first_event[qk][ts_field] if qk in self.first_event else event[ts_field]
+                filled = self.ref_window_filled_once
+                skip_until = self.skip_test.get(qk)
+                peak = self.cur_windows[qk].percentile(100) if qk in self.cur_windows else 0
+
+            # Same conditions as check_windows, without comparing the windows
+            ts = event[ts_field]
+            peak = max(peak, count)
+            if ts - first <= filling:
+                quiet = not (filled and new_data_alerts)
+            else:
+                filled = True
+                quiet = False
+            if quiet or (skip_until is not None and ts < skip_until) or (threshold is not None and peak < threshold):
+                run.append((event, count))
+                continue
+
+            if run:
+                self.append_events(run, qk)
+                self.ref_window_filled_once = filled
+                run = []
+            matches = len(self.matches)
+            self.handle_event(event, count, qk)
+            if len(self.matches) > matches:
+                matched.append(position)
+
+        if run:
+            self.append_events(run, qk)
+            self.ref_window_filled_once = filled
+        return matched
+
+    def append_event(self, event, count, qk='all', weight=1):
+        """ Add an event to the windows of qk, creating them if needed. A weight other
+        than 1 counts the event that many times and needs window_mode: pane. """
+
+        start = time.time()
         self.first_event.setdefault(qk, event)
+        self.create_windows(qk)
 
-        self.ref_windows.setdefault(qk, CustomEventWindow(self.timeframe, None,                        self.get_ts,self.rules.get('percentile_value')))
-        self.cur_windows.setdefault(qk, CustomEventWindow(self.timeframe, self.ref_windows[qk].append, self.get_ts,self.rules.get('percentile_value')))
+        if weight == 1:
+            self.cur_windows[qk].append((event, count))
+        else:
+            self.cur_windows[qk].append((event, count), weight)
+        self.update_last_seen(qk, event[self.ts_field])
+
+        self.metrics.counters['events_ingested'] += 1
+        self.metrics.timings['append'].observe(time.time() - start)
+
+    def append_events(self, events, qk='all'):
+        """ append_event for each (event, count) of events, the windows expire once. """
+        start = time.time()
+        self.first_event.setdefault(qk, events[0][0])
+        self.create_windows(qk)
+        self.cur_windows[qk].extend(events)
+        self.update_last_seen(qk, max(event[self.ts_field] for event, _ in events))
+
+        self.metrics.counters['events_ingested'] += len(events)
+        self.metrics.timings['append'].observe(time.time() - start)
+
+    def create_windows(self, qk):
+        if qk not in self.cur_windows:
+            if self.max_query_keys and len(self.cur_windows) >= self.max_query_keys:
+                self.evict_least_recent()
+            self.ref_windows[qk] = self.new_window()
+            self.cur_windows[qk] = self.new_window(self.ref_windows[qk])
+
+    def update_last_seen(self, qk, ts):
+        if qk in self.last_seen:
+            last = self.last_seen.pop(qk)
+            self.last_seen[qk] = max(last, ts)
+        else:
+            self.last_seen[qk] = ts
 
-        self.cur_windows[qk].append((event, count))
+    def check_windows(self, event, qk='all'):
+        """ Compare the windows of qk after event was added, and add a match if they spike. """
 
         # Don't alert if ref window has not yet been filled for this key AND
         if event[self.ts_field] - self.first_event[qk][self.ts_field] <= self.rules['timeframe'] * 2:
@@ -90,22 +419,51 @@ class PercentileOfFieldSpikeRule(SpikeRule):
         if qk in self.skip_test and event[self.ts_field] < self.skip_test[qk]:
             return
 
-        ref_count = self.ref_windows[qk].count()
-        cur_count = self.cur_windows[qk].count()
+        start = time.time()
+        ref_window = self.ref_windows[qk]
+        cur_window = self.cur_windows[qk]
+        spikes = []
+        for percentile in self.percentiles:
+            ref_count = ref_window.percentile(percentile)
+            cur_count = cur_window.percentile(percentile)
+            if self.find_matches(ref_count, cur_count, percentile):
+                spikes.append((percentile, ref_count, cur_count))
+        self.metrics.counters['evaluations'] += 1
+        self.metrics.timings['count'].observe(time.time() - start)
 
         #if (cur_count == 20):
         #    ref_validator = [[test[0]['ts'].strftime("%m/%d/%Y %H:%M:%S"),test[1]] for test in self.ref_windows[qk].data]
         #    cur_validator = [[test[0]['ts'].strftime("%m/%d/%Y %H:%M:%S"),test[1]] for test in self.cur_windows[qk].data]
         #    pass
 
-        if self.find_matches(ref_count,cur_count):
+        if spikes:
+            start = time.time()
             # skip over placeholder events which have count=0
-            for match, count in self.cur_windows[qk].data:
-                if count >= cur_count:
-                    break
+            _, ref_count, cur_count = spikes[0]
+            match, _ = cur_window.find_first(cur_count)
 
-            self.add_match(match, qk)
+            self.add_match(match, qk, spikes)
             self.clear_windows(qk, match)
+            self.metrics.counters['matches'] += 1
+            self.metrics.timings['match'].observe(time.time() - start)
+
+    def new_window(self, ref_window=None):
+        """ Create a window for a query_key. The current window feeds the events it
+        expires into ref_window. """
+        if self.window_mode == 'pane':
+            relative_error = None
+            if self.percentile_mode == 'approximate':
+                relative_error = self.rules.get('percentile_relative_error', 0.01)
+            onRemoved = ref_window.append_pane if ref_window is not None else None
+            return PaneEventWindow(self.timeframe, onRemoved, self.get_ts, self.percentiles[0],
+                                   self.window_resolution, relative_error)
+
+        if self.window_mode == 'compact':
+            onRemoved = ref_window.append_raw if ref_window is not None else None
+            return CompactEventWindow(self.timeframe, onRemoved, self.ts_field, self.percentiles[0])
+
+        onRemoved = ref_window.append if ref_window is not None else None
+        return CustomEventWindow(self.timeframe, onRemoved, self.get_ts, self.percentiles[0])
 
     def clear_windows(self, qk, event):
         # Reset the state and prevent alerts until windows filled again
@@ -114,12 +472,26 @@ class PercentileOfFieldSpikeRule(SpikeRule):
         self.ref_windows[qk].clear()
         self.first_event.pop(qk)
 
-    def add_match(self, match, qk):
-        extra_info = {'current_count': self.cur_windows[qk].count(),
-                      'reference_count': self.ref_windows[qk].count()}
+    def add_match(self, match, qk, spikes=None):
+        """ spikes are the (percentile, reference count, current count) which spiked,
+        the counts of the first one are reported as current_count and reference_count. """
+        if spikes is None:
+            percentile = self.percentiles[0]
+            spikes = [(percentile, self.ref_windows[qk].percentile(percentile),
+                       self.cur_windows[qk].percentile(percentile))]
+        percentile_value, reference_count, current_count = spikes[0]
+        extra_info = {'current_count': current_count,
+                      'reference_count': reference_count,
+                      'percentile_value': percentile_value,
+                      'current_window_size': window_size(self.cur_windows[qk]),
+                      'reference_window_size': window_size(self.ref_windows[qk])}
+        if len(self.percentiles) > 1:
+            extra_info['spiking_percentiles'] = [
+                {'percentile': percentile, 'current_count': cur_count, 'reference_count': ref_count}
+                for percentile, ref_count, cur_count in spikes]
 
         elastalert_logger.info('current_count: %s , reference_count: %s'
-            %(self.cur_windows[qk].count(),self.ref_windows[qk].count()))
+            %(current_count, reference_count))
 
         match = dict(match.items() + extra_info.items())
 
@@ -131,53 +503,180 @@ class PercentileOfFieldSpikeRule(SpikeRule):
             pretty_ts(match[self.rules['timestamp_field']], self.rules.get('use_local_time'))
         )
         message += 'Preceding that time, there were only %d events within %s\n\n' % (match['reference_count'], self.rules['timeframe'])
+        if 'percentile_value' in match:
+            message += 'Percentile %s of %s, over %d current and %d reference window entries\n' % (
+                match['percentile_value'], self.rules['target_field'],
+                match['current_window_size'], match['reference_window_size'])
+        for spike in match.get('spiking_percentiles', []):
+            message += 'Percentile %s: %s, preceded by %s\n' % (
+                spike['percentile'], spike['current_count'], spike['reference_count'])
         return message
 
+    def find_matches(self, ref, cur, percentile=None):
+        """ SpikeRule.find_matches, with the thresholds of one of the percentiles. """
+        thresholds = self.thresholds[self.percentiles[0] if percentile is None else percentile]
+
+        # Apply threshold limits
+        if cur < thresholds['threshold_cur'] or ref < thresholds['threshold_ref']:
+            return False
+
+        spike_up = cur >= ref * thresholds['spike_height']
+        spike_down = cur <= ref / thresholds['spike_height']
+        return ((self.rules['spike_type'] in ['both', 'up'] and spike_up) or
+                (self.rules['spike_type'] in ['both', 'down'] and spike_down))
+
+    def percentile_option(self, name, percentile, default=None):
+        """ Options like spike_height are either one value for every percentile
+        or a dict of values by percentile. """
+        value = self.rules.get(name, default)
+        if isinstance(value, dict):
+            value = value.get(percentile, default)
+        if value is None:
+            raise EAException('%s has no value for percentile %s' % (name, percentile))
+        return value
+
     def garbage_collect(self, ts):
-        pass
-    #    # Windows are sized according to their newest event
-    #    # This is a placeholder to accurately size windows in the absence of events
-    #    for qk in self.cur_windows.keys():
-    #        # If we havn't seen this key in a long time, forget it
-    #        if qk != 'all' and self.ref_windows[qk].count() == 0 and self.cur_windows[qk].count() == 0:
-    #            self.cur_windows.pop(qk)
-    #            self.ref_windows.pop(qk)
-    #            continue
-    #        placeholder = {self.ts_field: ts}
-    #        # The placeholder may trigger an alert, in which case, qk will be expected
-    #        if qk != 'all':
-    #            placeholder.update({self.rules['query_key']: qk})
-    #        self.handle_event(placeholder, 0, qk)
+        """ Forget the query_keys which have not been seen for longer than both
+        windows plus buffer_time, so no late document can still need them, and
+        the skip_test entries which are over. """
+        self.diagnostics.report()
+        if self.pool:
+            try:
+                self.worker_stats = self.pool.garbage_collect(ts)
+            except WorkerError as e:
+                self.stop_workers(e)
+            if self.metrics_exporter:
+                self.metrics_exporter.tick()
+            return
 
+        buffer_time = self.rules.get('buffer_time', datetime.timedelta(0))
+        idle_since = ts - self.rules['timeframe'] * 2 - buffer_time
 
+        idle = [qk for qk, last in self.last_seen.iteritems() if last < idle_since and qk != 'all']
+        for qk in idle:
+            self.forget_key(qk)
+        self.evicted_keys['idle'] += len(idle)
 
-class CustomEventWindow(EventWindow):
-    """ A container for hold event counts for rules which need a chronological ordered event window. """
+        # An alert for this qk has recently fired, keep this until it's over
+        for qk, skip_until in self.skip_test.items():
+            if ts - buffer_time >= skip_until:
+                self.skip_test.pop(qk)
 
-    def __init__(self, timeframe, onRemoved=None, getTimestamp=new_get_event_ts('@timestamp'), p_value=90):
-        super(CustomEventWindow, self ).__init__(timeframe, onRemoved, getTimestamp)         
-        self.p_value = p_value
+        if idle:
+            elastalert_logger.info('Evicted %d idle query_keys for rule %s, %d left (total evicted: %s)'
+                                   % (len(idle), self.rules['name'], len(self.cur_windows), self.evicted_keys))
+
+        if self.checkpointer:
+            self.checkpointer.tick()
+        if self.metrics_exporter:
+            self.metrics_exporter.tick()
+
+    def evict_least_recent(self):
+        """ Make room for a new query_key once max_query_keys are kept. """
+        while self.last_seen and len(self.cur_windows) >= self.max_query_keys:
+            qk = next(iter(self.last_seen))
+            self.forget_key(qk)
+            self.evicted_keys['max_query_keys'] += 1
+
+    def forget_key(self, qk):
+        """ Drop the windows of a query_key. skip_test is kept so that a key which
+        has just alerted can't alert again as soon as it's seen again. """
+        self.cur_windows.pop(qk, None)
+        self.ref_windows.pop(qk, None)
+        self.first_event.pop(qk, None)
+        self.last_seen.pop(qk, None)
+
+
+class IndexedEventWindow(EventWindow):
+    """ EventWindow which also keeps a MaxIndex of its counts, so the first event
+    with a given count is found without scanning the window. """
+
+    def __init__(self, timeframe, onRemoved=None, getTimestamp=new_get_event_ts('@timestamp')):
+        super(IndexedEventWindow, self).__init__(timeframe, onRemoved, getTimestamp)
+        self.index = MaxIndex()
+
+    def clear(self):
+        super(IndexedEventWindow, self).clear()
+        self.index = MaxIndex()
 
     def append(self, event):
         """ Add an event to the window. Event should be of the form (dict, count).
         This will also pop the oldest events and call onRemoved on them until the
         window size is less than timeframe. """
-        self.data.add(event)
+        self.extend((event,))
+
+    def extend(self, events):
+        """ Add several events, popping the oldest ones only once they are all in.
+        The window ends up the same as after appending them one by one. """
+        for event in events:
+            self.data.add(event)
+            self.running_count += event[1]
+            if self.data[-1] is event:
+                self.index.append(event[1])
+            else:
+                # Late event, this should be rare as hits come sorted by timestamp
+                self.index.dirty = True
 
-        while self.duration() >= self.timeframe:
+        newest = self.get_ts(self.data[-1]) if self.data else None
+        while self.data and newest - self.get_ts(self.data[0]) >= self.timeframe:
             oldest = self.data[0]
-            self.data.remove(oldest)
+            # The oldest event is the first one, no need to look it up
+            del self.data[0]
+            self.running_count -= oldest[1]
+            self.index.popleft()
+            self.expired(oldest)
             self.onRemoved and self.onRemoved(oldest)
 
+    def expired(self, event):
+        """ Called for every event leaving the window, before onRemoved. """
+        pass
+
+    def find_first(self, count, strict=False):
+        """ Get the oldest (event, count) with at least count (more than count when
+        strict), or the newest one if there is none. """
+        if self.index.dirty:
+            self.index.rebuild(event[1] for event in self.data)
+        position = self.index.find(count, strict)
+        if position is None:
+            return self.data[-1]
+        return self.data[position]
+
+
+class CustomEventWindow(IndexedEventWindow):
+    """ A container for hold event counts for rules which need a chronological ordered event window.
+    Besides the time ordered data, the window keeps a value ordered index of the counts so the
+    percentile can be looked up without sorting the whole window. """
+
+    def __init__(self, timeframe, onRemoved=None, getTimestamp=new_get_event_ts('@timestamp'), p_value=90):
+        super(CustomEventWindow, self ).__init__(timeframe, onRemoved, getTimestamp)         
+        self.p_value = p_value
+        self.values = sortedlist()
+
+    def clear(self):
+        super(CustomEventWindow, self).clear()
+        self.values = sortedlist()
+
+    def extend(self, events):
+        for event in events:
+            self.values.add(event[1])
+        super(CustomEventWindow, self).extend(events)
+
+    def expired(self, event):
+        self.values.remove(event[1])
+
     def append_middle(self, event):
         """ Attempt to place the event in the correct location in our deque.
         Returns True if successful, otherwise False. """
         raise NotImplementedError
 
     def count(self):
-
-        temp_list = sorted(self.data, key=lambda data: data[1])
-        p_posit = int(len(temp_list) * self.p_value/100) - 1
-        self.running_count = temp_list[p_posit][1]
-
+        """ Get the p_value percentile of the counts in the window. """
+        self.running_count = self.percentile(self.p_value)
         return self.running_count
+
+    def percentile(self, p_value):
+        """ Get any percentile of the counts in the window. """
+        if not self.values:
+            return 0
+        p_posit = int(len(self.values) * p_value/100) - 1
+        return self.values[p_posit]
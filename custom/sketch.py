@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable quantile sketch used by the approximate percentile mode.
+
+This is a small implementation of DDSketch (Masson et al., 2019): values are
+mapped to logarithmic buckets so that any quantile is returned with a bounded
+relative error. The number of buckets only depends on that error and on the
+range of the values, never on how many values were added, and two sketches
+can be merged or subtracted bucket by bucket.
+"""
+import math
+
+
+class _Store(object):
+    """ Bucket counts of one sign. When max_bins is set the lowest buckets are
+    collapsed into a single one, losing accuracy on the smallest values only. """
+
+    def __init__(self, max_bins=None):
+        self.bins = {}
+        self.floor = None
+        self.max_bins = max_bins
+
+    def key(self, index):
+        if self.floor is not None and index < self.floor:
+            return self.floor
+        return index
+
+    def add(self, index, weight=1):
+        index = self.key(index)
+        if index in self.bins:
+            self.bins[index] += weight
+        else:
+            self.bins[index] = weight
+            if self.max_bins and len(self.bins) > self.max_bins:
+                self.collapse()
+
+    def remove(self, index, weight=1):
+        index = self.key(index)
+        left = self.bins.get(index, 0) - weight
+        if left > 0:
+            self.bins[index] = left
+        else:
+            self.bins.pop(index, None)
+
+    def collapse(self):
+        indexes = sorted(self.bins)
+        extra = len(indexes) - self.max_bins
+        self.floor = indexes[extra]
+        for index in indexes[:extra]:
+            self.bins[self.floor] += self.bins.pop(index)
+
+
+class DDSketch(object):
+    """ Quantile sketch with relative_error accuracy on the returned values. """
+
+    def __init__(self, relative_error=0.01, max_bins=None):
+        if not 0 < relative_error < 1:
+            raise ValueError('relative_error must be between 0 and 1')
+        self.relative_error = relative_error
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = _Store(max_bins)
+        self.negative = _Store(max_bins)
+        self.zero_count = 0
+        self.count = 0
+
+    def index(self, value):
+        """ Bucket index of abs(value). Buckets cover (gamma^(i-1), gamma^i]. """
+        return int(math.ceil(math.log(abs(value)) / self.log_gamma))
+
+    def add(self, value, weight=1):
+        if value > 0:
+            self.positive.add(self.index(value), weight)
+        elif value < 0:
+            self.negative.add(self.index(value), weight)
+        else:
+            self.zero_count += weight
+        self.count += weight
+
+    def merge(self, other):
+        """ Add every bucket of other into this sketch. """
+        for index, weight in other.positive.bins.iteritems():
+            self.positive.add(index, weight)
+        for index, weight in other.negative.bins.iteritems():
+            self.negative.add(index, weight)
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def subtract(self, other):
+        """ Remove every bucket of other, which must have been merged before. """
+        for index, weight in other.positive.bins.iteritems():
+            self.positive.remove(index, weight)
+        for index, weight in other.negative.bins.iteritems():
+            self.negative.remove(index, weight)
+        self.zero_count -= other.zero_count
+        self.count -= other.count
+
+    def value(self, index):
+        """ Representative value of a positive bucket. """
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def value_at(self, rank):
+        """ Get the approximate value at the given 0-based rank. Like list indexing,
+        negative ranks count from the largest value. """
+        if self.count <= 0:
+            return 0
+        if rank < 0:
+            rank += self.count
+        rank = min(max(rank, 0), self.count - 1)
+
+        seen = 0
+        for index in sorted(self.negative.bins, reverse=True):
+            seen += self.negative.bins[index]
+            if seen > rank:
+                return -self.value(index)
+        seen += self.zero_count
+        if seen > rank:
+            return 0
+        for index in sorted(self.positive.bins):
+            seen += self.positive.bins[index]
+            if seen > rank:
+                return self.value(index)
+        return self.value(max(self.positive.bins)) if self.positive.bins else 0
+
+    def items(self):
+        """ (value, weight) pairs of the buckets, using their representative values. """
+        for index, weight in self.negative.bins.iteritems():
+            yield -self.value(index), weight
+        if self.zero_count:
+            yield 0, self.zero_count
+        for index, weight in self.positive.bins.iteritems():
+            yield self.value(index), weight
+
+    def __len__(self):
+        return len(self.positive.bins) + len(self.negative.bins) + (1 if self.zero_count else 0)
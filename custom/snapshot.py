@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoints of the per query_key window state of the spike rules, so a restart
+can resume alerting right away instead of waiting 2 * timeframe for the
+windows to fill again.
+
+The file is a flat little-endian binary layout which is read through mmap:
+
+    header  magic 'CRWS', version (H), ref_window_filled_once (B), keys (I), saved at (d)
+    key     key length (I), key as json, first event, skip until, last seen (3 d, NaN if unset),
+            then the ref and the cur window
+    window  entries (I), then that many epoch timestamps, counts and weights (3 arrays of d)
+"""
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+
+import dateutil.tz
+
+from elastalert.util import elastalert_logger
+
+from custom.compact import CompactEventWindow
+from custom.panes import PaneEventWindow
+from custom.util import dt_to_epoch
+from custom.util import epoch_to_dt
+
+MAGIC = 'CRWS'
+VERSION = 1
+HEADER = struct.Struct('<4sHBId')
+KEY = struct.Struct('<I')
+KEY_STATE = struct.Struct('<ddd')
+WINDOW = struct.Struct('<I')
+NAN = float('nan')
+
+
+def skip_until(rule):
+    """ PercentileOfFieldSpikeRule keeps its own skip_test, SpikeRule uses skip_checks. """
+    return rule.skip_test if hasattr(rule, 'skip_test') else rule.skip_checks
+
+
+def window_entries(window):
+    """ (epoch, count, weight) triples of any of the window types. """
+    if isinstance(window, (CompactEventWindow, PaneEventWindow)):
+        return list(window.entries())
+    return [(dt_to_epoch(window.get_ts(event)), event[1], 1) for event in window.data]
+
+
+def restore_entry(window, ts_field, ts, count, weight):
+    if isinstance(window, CompactEventWindow):
+        window.tzinfo = dateutil.tz.tzutc()
+        window.append_raw(ts, count)
+        return
+
+    if count == int(count):
+        count = int(count)
+    event = ({ts_field: epoch_to_dt(ts, dateutil.tz.tzutc())}, count)
+    if isinstance(window, PaneEventWindow):
+        window.append(event, weight)
+    else:
+        window.append(event)
+
+
+def to_epoch(dt):
+    return NAN if dt is None else dt_to_epoch(dt)
+
+
+def to_dt(epoch):
+    return None if math.isnan(epoch) else epoch_to_dt(epoch, dateutil.tz.tzutc())
+
+
+def native(values):
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def save(rule, path):
+    """ Write the window state of rule to path, atomically replacing the previous one. """
+    skip = skip_until(rule)
+    last_seen = getattr(rule, 'last_seen', {})
+    chunks = [HEADER.pack(MAGIC, VERSION, rule.ref_window_filled_once, len(rule.cur_windows), time.time())]
+
+    for qk in rule.cur_windows:
+        key = json.dumps(qk)
+        first_event = rule.first_event.get(qk)
+        chunks.append(KEY.pack(len(key)) + key)
+        chunks.append(KEY_STATE.pack(to_epoch(first_event and first_event[rule.ts_field]),
+                                     to_epoch(skip.get(qk)), to_epoch(last_seen.get(qk))))
+        for window in (rule.ref_windows[qk], rule.cur_windows[qk]):
+            entries = window_entries(window)
+            chunks.append(WINDOW.pack(len(entries)))
+            for column in zip(*entries) or ((), (), ()):
+                chunks.append(native(array('d', column)).tostring())
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as snapshot_file:
+        snapshot_file.write(''.join(chunks))
+    os.rename(temp_path, path)
+
+
+def load(rule, path, now=None):
+    """ Restore the window state of rule from path, leaving out whatever is older
+    than both windows. Returns the number of query_keys restored. """
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return 0
+    now = time.time() if now is None else now
+    horizon = now - rule.timeframe.total_seconds() * 2
+
+    with open(path, 'rb') as snapshot_file:
+        buf = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, filled_once, keys, saved_at = HEADER.unpack_from(buf, 0)
+            if magic != MAGIC or version != VERSION:
+                elastalert_logger.warning('Ignoring window snapshot %s with an unknown format' % (path))
+                return 0
+
+            offset = HEADER.size
+            restored = 0
+            skip = skip_until(rule)
+            last_seen = getattr(rule, 'last_seen', None)
+            for _ in xrange(keys):
+                key_length, = KEY.unpack_from(buf, offset)
+                offset += KEY.size
+                qk = json.loads(buf[offset:offset + key_length])
+                qk = tuple(qk) if isinstance(qk, list) else qk
+                offset += key_length
+                first_event, skip_ts, last_ts = KEY_STATE.unpack_from(buf, offset)
+                offset += KEY_STATE.size
+
+                windows = []
+                for _ in range(2):
+                    entries, = WINDOW.unpack_from(buf, offset)
+                    offset += WINDOW.size
+                    columns = []
+                    for _ in range(3):
+                        column = array('d')
+                        column.fromstring(buf[offset:offset + entries * column.itemsize])
+                        columns.append(native(column))
+                        offset += entries * column.itemsize
+                    windows.append(columns)
+
+                newest = [max(times) for times, _, _ in windows if times]
+                if not math.isnan(last_ts):
+                    newest.append(last_ts)
+                if not newest or max(newest) < horizon:
+                    continue
+                if not math.isnan(skip_ts) and skip_ts >= now:
+                    skip[qk] = to_dt(skip_ts)
+                if math.isnan(first_event):
+                    continue
+
+                rule.first_event[qk] = {rule.ts_field: to_dt(first_event)}
+                rule.ref_windows[qk] = rule.new_window()
+                rule.cur_windows[qk] = rule.new_window(rule.ref_windows[qk])
+                if last_seen is not None and not math.isnan(last_ts):
+                    last_seen[qk] = to_dt(last_ts)
+                for window, (times, counts, weights) in zip((rule.ref_windows[qk], rule.cur_windows[qk]), windows):
+                    for ts, count, weight in zip(times, counts, weights):
+                        if ts >= horizon:
+                            restore_entry(window, rule.ts_field, ts, count, weight)
+                restored += 1
+        finally:
+            buf.close()
+
+    rule.ref_window_filled_once = rule.ref_window_filled_once or bool(filled_once)
+    elastalert_logger.info('Restored the windows of %d query_keys from %s, saved %d seconds ago'
+                           % (restored, path, now - saved_at))
+    return restored
+
+
+class Checkpointer(object):
+    """ Saves a rule's window state every interval, on its garbage_collect tick. """
+
+    def __init__(self, rule, path, interval):
+        self.rule = rule
+        self.path = path
+        self.interval = interval.total_seconds()
+        self.saved_at = time.time()
+
+    def tick(self):
+        if time.time() - self.saved_at < self.interval:
+            return
+        try:
+            save(self.rule, self.path)
+        except (IOError, OSError) as e:
+            elastalert_logger.warning('Could not save window snapshot %s: %s' % (self.path, e))
+        self.saved_at = time.time()
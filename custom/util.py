@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import datetime
+import re
+
+import dateutil.tz
+
+from elastalert.util import ts_to_dt
+
+
+UTC = dateutil.tz.tzutc()
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=UTC)
+NAIVE_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def dt_to_epoch(dt):
+    """ Convert a datetime into float seconds since the epoch, keeping microseconds. """
+    if dt.tzinfo is None:
+        return (dt - NAIVE_EPOCH).total_seconds()
+    return (dt - EPOCH).total_seconds()
+
+
+def to_timedelta(value, default=None):
+    """ Rule options which are not converted by ElastAlert (e.g. window_resolution)
+    may come either as a timedelta or as a dict straight from the yaml file. """
+    if value is None:
+        return default
+    if isinstance(value, datetime.timedelta):
+        return value
+    if isinstance(value, dict):
+        return datetime.timedelta(**value)
+    return datetime.timedelta(seconds=value)
+
+
+def epoch_to_dt(epoch, tzinfo=None):
+    """ Inverse of dt_to_epoch, giving an aware datetime when tzinfo is set. """
+    if tzinfo is None:
+        return NAIVE_EPOCH + datetime.timedelta(seconds=epoch)
+    return (EPOCH + datetime.timedelta(seconds=epoch)).astimezone(tzinfo)
+
+
+ISO_TIMESTAMP = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:[.,](\d{1,6}))?'
+                           r'(?:(Z)|([+-])(\d\d):?(\d\d))?$')
+
+
+def iso_to_dt(timestamp):
+    """ Same as ElastAlert's ts_to_dt, parsing plain ISO 8601 timestamps without
+    dateutil's generic parser, which is slow for bulk conversions. """
+    match = ISO_TIMESTAMP.match(timestamp) if isinstance(timestamp, basestring) else None
+    if match is None:
+        return ts_to_dt(timestamp)
+
+    year, month, day, hour, minute, second, fraction, _, sign, tz_hours, tz_minutes = match.groups()
+    tzinfo = UTC
+    if sign:
+        offset = int(tz_hours) * 3600 + int(tz_minutes) * 60
+        if offset:
+            tzinfo = dateutil.tz.tzoffset(None, -offset if sign == '-' else offset)
+    return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                             int(fraction.ljust(6, '0')) if fraction else 0, tzinfo)
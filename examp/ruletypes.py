@@ -6,29 +6,55 @@ discarded (i.e. use_count_query would have sufficed), as it does not
 preserve them.
 """
 import copy
+import datetime
+import time
 
 from elastalert.ruletypes import RuleType
 from elastalert.ruletypes import FrequencyRule
 from elastalert.ruletypes import SpikeRule
 from elastalert.ruletypes import FlatlineRule
-from elastalert.ruletypes import EventWindow
 from elastalert.util import lookup_es_key
 from elastalert.util import elastalert_logger
 from elastalert.util import pretty_ts
+from elastalert.util import EAException
+
+from custom import columns
+from custom import snapshot
+from custom.compact import CompactEventWindow
+from custom.dedupe import duplicate_filter
+from custom.fields import field_getter
+from custom.fields import FieldDiagnostics
+from custom.metrics import MetricsExporter
+from custom.metrics import RuleMetrics
+from custom.metrics import window_size
+from custom.panes import PaneEventWindow
+from custom.ruletypes import IndexedEventWindow
+from custom.util import to_timedelta
 
 
 def verify_integer_field(document, rule, target_field, allow_zero=False):
     count = lookup_es_key(document, target_field)
+    return verify_integer(count, rule, target_field, allow_zero)
+
+
+def verify_integer(count, rule, target_field, allow_zero=False, diagnostics=None):
+    # With diagnostics, invalid documents are counted there instead of logged
     # Attempt to convert strings to ints
     if isinstance(count, basestring):
         try:
             count = int(count)
         except ValueError:
+            if diagnostics is not None:
+                diagnostics.add('with a non-integer', target_field)
+                return None
             elastalert_logger.warning(
                 'Field %s is a string which could not be converted'
                 'into an integer for rule %s' % (target_field, rule['name']))
             return None
     if count is None:
+        if diagnostics is not None:
+            diagnostics.add('without', target_field)
+            return None
         elastalert_logger.warning(
             'Did not find field %s representing document count in '
             'document for rule %s' % (target_field, rule['name']))
@@ -36,6 +62,9 @@ def verify_integer_field(document, rule, target_field, allow_zero=False):
     if isinstance(count, float):
         count = int(count)
     if not isinstance(count, (int, long)):
+        if diagnostics is not None:
+            diagnostics.add('with a non-integer', target_field)
+            return None
         elastalert_logger.warning(
             'Non-integer value of field %s representing document '
             'count in document for rule %s: %s'
@@ -56,53 +85,313 @@ class SumOfFieldRuleFactory(type):
     # having to reimplement all the common logic for each backing_rule_type.
 
     def __new__(mcs, name, _, dct):
+        backing_rule_type_cls = dct['backing_rule_type']
+
+        def __init__(self, *args):
+            backing_rule_type_cls.__init__(self, *args)
+
+            self.get_timestamp = field_getter(self.ts_field)
+            self.get_target = field_getter(self.rules['target_field'])
+            self.diagnostics = FieldDiagnostics(self.rules['name'], to_timedelta(
+                self.rules.get('diagnostics_interval'), datetime.timedelta(minutes=1)))
+            self.duplicates = duplicate_filter(self)
+
+            self.metrics = RuleMetrics(self)
+            self.metrics_exporter = None
+            if self.rules.get('metrics_file'):
+                self.metrics_exporter = MetricsExporter(self.metrics, self.rules['metrics_file'], to_timedelta(
+                    self.rules.get('metrics_interval'), datetime.timedelta(minutes=1)))
+
+            # Sum the counts of each timestamp, or coalesce_interval, of a batch
+            # before they reach the backing rule
+            self.coalesce_interval = None
+            if self.rules.get('coalesce_counts'):
+                self.coalesce_interval = to_timedelta(self.rules.get('coalesce_interval'), datetime.timedelta(0))
+
+            # Only the spike rules keep windows which can be checkpointed
+            self.checkpointer = None
+            if self.rules.get('state_file') and isinstance(self, SpikeRule):
+                snapshot.load(self, self.rules['state_file'])
+                self.checkpointer = snapshot.Checkpointer(self, self.rules['state_file'], to_timedelta(
+                    self.rules.get('state_checkpoint_interval'), datetime.timedelta(minutes=1)))
+
+
+        def garbage_collect(self, ts):
+            backing_rule_type_cls.garbage_collect(self, ts)
+            self.diagnostics.report()
+            if self.checkpointer:
+                self.checkpointer.tick()
+            if self.metrics_exporter:
+                self.metrics_exporter.tick()
+
+
+        def add_data(self, data, shared=None):
+            # shared is the columns.Columns of data when the rule is part of a RuleGroup
+            if self.duplicates is not None:
+                new_data = self.duplicates.filter(data)
+                self.metrics.counters['events_duplicate'] += len(data) - len(new_data)
+                if len(new_data) < len(data):
+                    shared = None
+                data = new_data
 
-        def add_data(self, data):
+            if self.rules.get('batch_ingest') or shared is not None:
+                return self.add_batch(data, shared)
+
+            extract_timing = self.metrics.timings['extract']
+            target_field = self.rules['target_field']
+            pairs = []
             for document in data:
-                count = verify_integer_field(
-                    document, self.rules, self.rules['target_field'])
-                ts = lookup_es_key(document, self.ts_field)
+                start = time.time()
+                count = verify_integer(
+                    self.get_target(document), self.rules, target_field, diagnostics=self.diagnostics)
+                ts = self.get_timestamp(document)
+                if ts is None and count:
+                    self.diagnostics.add('without', self.ts_field)
                 if count and ts:
-                    super(self.__class__, self).add_count_data({ts: count})
+                    extract_timing.observe(time.time() - start)
+                    if self.coalesce_interval is None:
+                        self.add_count_data({ts: count})
+                    else:
+                        pairs.append((ts, count))
+                else:
+                    self.metrics.counters['events_dropped'] += 1
+
+            if pairs:
+                self.add_coalesced(pairs)
+
+
+        def add_batch(self, data, shared=None):
+            start = time.time()
+            if shared is None:
+                shared = columns.Columns(data)
+            timestamps = shared.field(self.ts_field)
+            counts = shared.field(self.rules['target_field'])
+            numeric = shared.numbers(self.rules['target_field'])
+            if numeric is not None:
+                # Plain numbers only need the float truncation and the sign check
+                counts = numeric.astype(columns.np.int64)
+                counts = [count if count > 0 else None for count in counts.tolist()]
+            else:
+                target_field = self.rules['target_field']
+                counts = [verify_integer(count, self.rules, target_field, diagnostics=self.diagnostics)
+                          for count in counts]
+            self.metrics.timings['extract'].observe(time.time() - start)
+            self.metrics.counters['events_dropped'] += sum(
+                1 for ts, count in zip(timestamps, counts) if not (count and ts))
+            missing_timestamps = sum(1 for ts, count in zip(timestamps, counts) if count and ts is None)
+            if missing_timestamps:
+                self.diagnostics.add('without', self.ts_field, missing_timestamps)
+
+            pairs = [(ts, count) for ts, count in zip(timestamps, counts) if count and ts]
+            if self.coalesce_interval is not None:
+                return self.add_coalesced(pairs)
+
+            if isinstance(self, SpikeRule):
+                self.handle_pairs(pairs)
+            else:
+                add_count_data = self.add_count_data
+                for ts, count in pairs:
+                    add_count_data({ts: count})
+
+
+        def handle_pairs(self, pairs):
+            # Same as SpikeRule.add_count_data of each pair. Runs of counts after
+            # which the windows are not compared, or their sum can't reach
+            # threshold_cur, are appended in one go.
+            ts_field = self.ts_field
+            filling = self.rules['timeframe'] * 2
+            new_data_alerts = self.rules.get('query_key') and self.rules.get('alert_on_new_data')
+            threshold = self.rules.get('threshold_cur', 0)
+            run = []
+            for ts, count in pairs:
+                if not run:
+                    first = self.first_event['all'][ts_field] if 'all' in self.first_event else ts
+                    filled = self.ref_window_filled_once
+                    skip_until = self.skip_checks.get('all')
+                    total = self.cur_windows['all'].count() if 'all' in self.cur_windows else 0
+
+                # Same conditions as handle_event, without comparing the windows
+                total += count
+                if ts - first < filling:
+                    quiet = not (filled and new_data_alerts) or (skip_until is not None and ts < skip_until)
+                else:
+                    filled = True
+                    quiet = total < threshold
+                if quiet:
+                    run.append(({ts_field: ts}, count))
+                    continue
+
+                if run:
+                    self.append_events(run)
+                    self.ref_window_filled_once = filled
+                    run = []
+                self.handle_event({ts_field: ts}, count, 'all')
+
+            if run:
+                self.append_events(run)
+                self.ref_window_filled_once = filled
+
+
+        def append_events(self, events):
+            start = time.time()
+            self.first_event.setdefault('all', events[0][0])
+            self.create_windows('all')
+            self.cur_windows['all'].extend(events)
+            self.metrics.counters['events_ingested'] += len(events)
+            self.metrics.timings['append'].observe(time.time() - start)
+
+
+        def create_windows(self, qk):
+            if qk not in self.cur_windows:
+                self.ref_windows[qk] = self.new_window()
+                self.cur_windows[qk] = self.new_window(self.ref_windows[qk])
+
+
+        def add_coalesced(self, pairs):
+            # The counts of a group are only summed when none of their partial
+            # sums could match. A match resets the windows and the rest of the
+            # counts start new ones, the sum would have absorbed them instead.
+            for ts, counts in columns.coalesce(pairs, self.coalesce_interval):
+                if isinstance(self, SpikeRule):
+                    # Only the first count of a timestamp can slide the windows
+                    event = {self.ts_field: ts}
+                    matches = self.metrics.counters['matches']
+                    self.handle_event(event, counts[0], 'all')
+                    counts = counts[1:]
+                    summable = self.metrics.counters['matches'] == matches and not self.could_spike(event, counts)
+                else:
+                    window = self.occurrences.get('all')
+                    summable = (window.count() if window else 0) + sum(counts) < self.rules['num_events']
+
+                if summable and len(counts) > 1:
+                    self.metrics.counters['events_coalesced'] += len(counts) - 1
+                    counts = [sum(counts)]
+                for count in counts:
+                    if isinstance(self, SpikeRule):
+                        self.handle_event({self.ts_field: ts}, count, 'all')
+                    else:
+                        self.add_count_data({ts: count})
+
+
+        def could_spike(self, event, counts):
+            """ Whether adding counts one by one at the timestamp of event, the
+            last event added, would find a spike. """
+            if not counts or not self.evaluates(event, 'all'):
+                return False
+            ref_count = self.ref_windows['all'].count()
+            cur_count = self.cur_windows['all'].count()
+            for count in counts:
+                cur_count += count
+                if self.find_matches(ref_count, cur_count):
+                    return True
+            return False
+
+
+        def add_count_data(self, data):
+            # FrequencyRule checks for a match on every event, so this times both
+            start = time.time()
+            backing_rule_type_cls.add_count_data(self, data)
+            self.metrics.counters['events_ingested'] += len(data)
+            self.metrics.counters['evaluations'] += len(data)
+            self.metrics.timings['append'].observe(time.time() - start)
+
+
+        def add_match(self, *args):
+            start = time.time()
+            backing_rule_type_cls.add_match(self, *args)
+            self.metrics.counters['matches'] += 1
+            self.metrics.timings['match'].observe(time.time() - start)
+
+
+        def add_spike(self, match, qk, ref_count, cur_count):
+            # Same payload as SpikeRule.add_match, with the counts handle_event
+            # compared instead of counting the windows again
+            start = time.time()
+            RuleType.add_match(self, dict(match, spike_count=cur_count, reference_count=ref_count,
+                                          current_window_size=window_size(self.cur_windows[qk]),
+                                          reference_window_size=window_size(self.ref_windows[qk])))
+            self.metrics.counters['matches'] += 1
+            self.metrics.timings['match'].observe(time.time() - start)
+
+
+        def new_window(self, ref_window=None):
+            window_mode = self.rules.get('window_mode', 'event')
+            if window_mode == 'pane':
+                resolution = to_timedelta(self.rules.get('window_resolution'), datetime.timedelta(seconds=1))
+                onRemoved = ref_window.append_pane if ref_window is not None else None
+                return PaneEventWindow(self.timeframe, onRemoved, self.get_ts, resolution=resolution)
+            if window_mode == 'compact':
+                onRemoved = ref_window.append_raw if ref_window is not None else None
+                return CompactEventWindow(self.timeframe, onRemoved, self.ts_field)
+            if window_mode != 'event':
+                raise EAException('window_mode must be one of event, compact or pane')
+
+            onRemoved = ref_window.append if ref_window is not None else None
+            return IndexedEventWindow(self.timeframe, onRemoved, self.get_ts)
 
 
         def handle_event(self, event, count, qk='all'):
+            start = time.time()
             self.first_event.setdefault(qk, event)
+            self.create_windows(qk)
+            self.cur_windows[qk].append((event, count))
+            self.metrics.counters['events_ingested'] += 1
+            self.metrics.timings['append'].observe(time.time() - start)
 
-            self.ref_windows.setdefault(qk, EventWindow(self.timeframe, getTimestamp=self.get_ts))
-            self.cur_windows.setdefault(qk, EventWindow(self.timeframe, self.ref_windows[qk].append, self.get_ts))
+            if not self.evaluates(event, qk):
+                return
+
+            start = time.time()
+            ref_count = self.ref_windows[qk].count()
+            cur_count = self.cur_windows[qk].count()
+            self.metrics.counters['evaluations'] += 1
+            self.metrics.timings['count'].observe(time.time() - start)
+
+            if self.find_matches(ref_count, cur_count):
+                # skip over placeholder events which have count=0
+                match, _ = self.cur_windows[qk].find_first(0, strict=True)
+
+                self.add_spike(match, qk, ref_count, cur_count)
+                self.clear_windows(qk, match)
 
-            self.cur_windows[qk].append((event, count))
 
+        def evaluates(self, event, qk):
+            """ Whether the windows of qk are compared after adding event. """
             # Don't alert if ref window has not yet been filled for this key AND
             if event[self.ts_field] - self.first_event[qk][self.ts_field] < self.rules['timeframe'] * 2:
                 # ElastAlert has not been running long enough for any alerts OR
                 if not self.ref_window_filled_once:
-                    return
+                    return False
                 # This rule is not using alert_on_new_data (with query_key) OR
                 if not (self.rules.get('query_key') and self.rules.get('alert_on_new_data')):
-                    return
+                    return False
                 # An alert for this qk has recently fired
                 if qk in self.skip_checks and event[self.ts_field] < self.skip_checks[qk]:
-                    return
+                    return False
             else:
                 self.ref_window_filled_once = True
+            return True
 
-            if self.find_matches(self.ref_windows[qk].count(), self.cur_windows[qk].count()):
-                # skip over placeholder events which have count=0
-                for match, count in self.cur_windows[qk].data:
-                    if count:
-                        break
 
-                self.add_match(match, qk)
-                self.clear_windows(qk, match)
-
-
-        backing_rule_type_cls = dct['backing_rule_type']
         dct['required_options'] = (
             dct['backing_rule_type'].required_options | frozenset(['target_field']))
+        dct['__init__'] = __init__
+        dct['garbage_collect'] = garbage_collect
         dct['add_data'] = add_data
+        dct['add_batch'] = add_batch
+        dct['add_coalesced'] = add_coalesced
+        dct['could_spike'] = could_spike
+        dct['handle_pairs'] = handle_pairs
+        dct['append_events'] = append_events
+        dct['create_windows'] = create_windows
+        if not issubclass(backing_rule_type_cls, SpikeRule):
+            # The spike rules are measured in handle_event instead
+            dct['add_count_data'] = add_count_data
+        dct['add_match'] = add_match
+        dct['add_spike'] = add_spike
         dct['handle_event'] = handle_event
+        dct['evaluates'] = evaluates
+        dct['new_window'] = new_window
         return type.__new__(mcs, name, (backing_rule_type_cls,), dct)
 
 
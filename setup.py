@@ -11,7 +11,7 @@ setup(name='CustomRule',
       version='1.0',
       license='BSD License',
       include_package_data=True,
-      packages=find_packages(exclude=['examp','tests']),
+      packages=find_packages(exclude=['examp','tests','benchmarks']),
       url='https://www.inmetrics.com.br/',
       description='Elastialert Custom Rule',
       author='Leandro Sampaio',
@@ -26,6 +26,7 @@ setup(name='CustomRule',
       ],
       install_requires=['elastalert'],
       extras_require={
-            'dev': ['elastalert']
+            'dev': ['elastalert'],
+            'batch': ['numpy']
       }
 )
\ No newline at end of file
@@ -0,0 +1,21 @@
+import json
+import os
+
+from benchmarks import suite
+
+BASELINE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'benchmarks', 'baseline-quick.json')
+
+
+def test_quick_baseline():
+    with open(BASELINE) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    # Every case of the quick sweep can be checked against the baseline
+    names = [suite.case_name(case) for case in suite.cases(suite.QUICK)]
+    assert sorted(names) == sorted(baseline)
+
+    assert suite.regressions(baseline, baseline, 0.25) == []
+    slower = dict((name, dict(result, events_per_second=result['events_per_second'] / 2))
+                  for name, result in baseline.items())
+    assert len(suite.regressions(slower, baseline, 0.25)) == len(baseline)
@@ -1,12 +1,31 @@
+import gzip
 import json
+import random
 import mock
 import tests
 import pytest
 import datetime
+from fractions import Fraction
 
 from custom.ruletypes import PercentileOfFieldSpikeRule
+from custom.ruletypes import CustomEventWindow
+from custom.ruletypes import interval_period
+from custom.compact import CompactEventWindow
+from custom.group import RuleGroup
+from custom.panes import Histogram
+from custom.panes import PaneEventWindow
+from custom.panes import percentile_rank
+from custom import columns
+from custom import fields
+from custom import group as group_module
+from custom import replay
+from custom import snapshot
+from custom.util import dt_to_epoch
+from custom.util import iso_to_dt
 
 from elastalert.util import EAException
+from elastalert.util import dt_to_ts
+from elastalert.util import lookup_es_key
 from elastalert.util import ts_now
 from elastalert.util import ts_to_dt
 
@@ -73,3 +92,704 @@ def _test2_rule():
 
     assert len(RULES.matches) == 1
 
+
+def test_window_percentile_index():
+
+    window = CustomEventWindow(datetime.timedelta(seconds=30), getTimestamp=lambda e: e[0]['ts'], p_value=90)
+    events = hits(100, timestamp_field='ts')
+
+    for n, document in enumerate(events):
+        window.append((document, (n * 7) % 13))
+
+        expected = sorted([count for _, count in window.data])
+        assert window.count() == expected[int(len(expected) * 90 / 100) - 1]
+
+    assert len(window.values) == len(window.data)
+
+    window.clear()
+    assert window.count() == 0
+
+
+def percentile_rule(**kwargs):
+    rules = {
+        'name': 'PercentileOfFieldSpikeRule',
+        'threshold_cur': 10,
+        'spike_height': 2,
+        'timeframe': datetime.timedelta(seconds=5),
+        'spike_type': 'up',
+        'target_field': 'cpu',
+        'use_count_query': False,
+        'percentile_value': 90,
+        'timestamp_field': 'ts'
+    }
+    rules.update(kwargs)
+    return PercentileOfFieldSpikeRule(rules)
+
+
+def spike_events(seed=0):
+    rand = random.Random(seed)
+    events = []
+    for n in range(60):
+        ts = ts_to_dt('2000-01-01T00:%s:%sZ' % (n / 60, n % 60))
+        base = 50 if 40 <= n < 45 else 10
+        for _ in range(20):
+            events.append(event(ts, timestamp_field='ts', cpu=base + rand.randint(0, 5)))
+    return events
+
+
+def test_approximate_percentile_mode():
+
+    exact = percentile_rule()
+    approximate = percentile_rule(percentile_mode='approximate', percentile_relative_error=0.01)
+
+    for document in spike_events():
+        exact.add_data([document])
+        approximate.add_data([document])
+
+        for windows in ('cur_windows', 'ref_windows'):
+            exact_count = getattr(exact, windows)['all'].count()
+            approximate_count = getattr(approximate, windows)['all'].count()
+            assert abs(approximate_count - exact_count) <= exact_count * 0.01
+
+    assert len(exact.matches) == len(approximate.matches) == 1
+    assert exact.matches[0]['ts'] == approximate.matches[0]['ts']
+
+
+def test_approximate_window_is_bounded():
+
+    rule = percentile_rule(percentile_mode='approximate')
+    rule.add_data(spike_events())
+
+    window = rule.cur_windows['all']
+    assert len(window.panes) <= 5
+    assert len(window.values) <= 10
+
+
+def test_pane_window_mode():
+
+    exact = percentile_rule()
+    pane = percentile_rule(window_mode='pane', window_resolution={'seconds': 1})
+
+    for document in spike_events():
+        exact.add_data([document])
+        pane.add_data([document])
+        assert exact.cur_windows['all'].count() == pane.cur_windows['all'].count()
+        assert exact.ref_windows['all'].count() == pane.ref_windows['all'].count()
+
+    assert len(exact.matches) == len(pane.matches) == 1
+    assert exact.matches[0]['ts'] == pane.matches[0]['ts']
+
+
+def keyed_events(keys=5, seed=0):
+    rand = random.Random(seed)
+    events = []
+    for n in range(60):
+        ts = ts_to_dt('2000-01-01T00:%s:%sZ' % (n / 60, n % 60))
+        for _ in range(20):
+            host = rand.randint(0, keys - 1)
+            base = 50 if 50 - host * 5 <= n < 55 - host * 5 else 10
+            events.append(event(ts, timestamp_field='ts', host='h%d' % (host), cpu=base + rand.randint(0, 5)))
+    events.append(event(ts, timestamp_field='ts', cpu=10))
+    return events
+
+
+def test_batch_ingest():
+
+    for options in ({}, {'query_key': 'host'}, {'query_key': 'host', 'alert_on_new_data': True},
+                    {'query_key': 'host', 'max_query_keys': 3}):
+        single = percentile_rule(**options)
+        batch = percentile_rule(batch_ingest=True, **options)
+
+        single.add_data(keyed_events())
+        batch.add_data(keyed_events())
+
+        if 'max_query_keys' not in options:
+            assert len(single.matches) > 0
+        assert single.matches == batch.matches
+        assert single.evicted_keys == batch.evicted_keys
+
+
+def test_batch_ingest_runs():
+    # Events whose percentiles can't reach threshold_cur are appended in runs,
+    # without comparing the windows after each of them
+    for options in ({}, {'window_mode': 'pane'}, {'window_mode': 'compact'}, {'spike_type': 'both'}):
+        single = percentile_rule(query_key='host', threshold_cur=40, **options)
+        batch = percentile_rule(query_key='host', threshold_cur=40, batch_ingest=True, **options)
+
+        single.add_data(keyed_events())
+        batch.add_data(keyed_events())
+
+        assert len(single.matches) > 0
+        assert single.matches == batch.matches
+        assert batch.metrics.counters['evaluations'] < single.metrics.counters['evaluations']
+        assert batch.metrics.counters['events_ingested'] == single.metrics.counters['events_ingested']
+        for qk in single.cur_windows:
+            assert single.cur_windows[qk].count() == batch.cur_windows[qk].count()
+            assert single.ref_windows[qk].count() == batch.ref_windows[qk].count()
+
+
+def test_window_extend():
+
+    timeframe = datetime.timedelta(seconds=10)
+    get_ts = lambda e: e[0]['ts']
+    rand = random.Random(2)
+    entries = []
+    for n, document in enumerate(hits(200, timestamp_field='ts')):
+        late = event(document['ts'] - datetime.timedelta(seconds=rand.randint(0, 5)), timestamp_field='ts')
+        entries.extend([(document, n % 17 + 1), (late, n % 5 + 1)])
+
+    for new_window in (lambda ref=None: CustomEventWindow(timeframe, ref and ref.append, get_ts, 50),
+                       lambda ref=None: CompactEventWindow(timeframe, ref and ref.append_raw, 'ts', 50),
+                       lambda ref=None: PaneEventWindow(timeframe, ref and ref.append_pane, get_ts, 50)):
+        appended_ref = new_window()
+        appended = new_window(appended_ref)
+        extended_ref = new_window()
+        extended = new_window(extended_ref)
+        for offset in range(0, len(entries), 37):
+            for entry in entries[offset:offset + 37]:
+                appended.append(entry)
+            extended.extend(entries[offset:offset + 37])
+
+            for windows in ((appended, extended), (appended_ref, extended_ref)):
+                assert [count for _, count in windows[0].data] == [count for _, count in windows[1].data]
+                assert windows[0].count() == windows[1].count()
+            assert appended.find_first(10) == extended.find_first(10)
+
+
+def test_garbage_collect_idle_keys():
+
+    rule = percentile_rule(query_key='host', buffer_time=datetime.timedelta(seconds=5))
+    rule.add_data(keyed_events())
+    assert len(rule.cur_windows) == 6
+
+    # Seen up to 00:59, both windows and buffer_time span 15 seconds
+    rule.garbage_collect(ts_to_dt('2000-01-01T00:01:14Z'))
+    assert len(rule.cur_windows) == 6
+
+    rule.garbage_collect(ts_to_dt('2000-01-01T00:01:15Z'))
+    assert rule.cur_windows == rule.ref_windows == rule.first_event == {}
+    assert rule.evicted_keys['idle'] == 6
+    assert rule.skip_test == {}
+
+
+def test_evicted_key_keeps_skip_test():
+
+    rule = percentile_rule(query_key='host', alert_on_new_data=True, max_query_keys=1)
+    steady = hits(20, timestamp_field='ts', host='h0', cpu=10)
+    spike = hits(5, time_delta=datetime.timedelta(seconds=20), timestamp_field='ts', host='h0', cpu=50)
+    rule.add_data(steady + spike)
+    assert len(rule.matches) == 1
+
+    # h1 takes the place of h0, which is still not allowed to alert again as a new key
+    rule.add_data(hits(1, time_delta=datetime.timedelta(seconds=25), timestamp_field='ts', host='h1', cpu=1))
+    assert rule.cur_windows.keys() == ['h1']
+    rule.add_data(hits(1, time_delta=datetime.timedelta(seconds=26), timestamp_field='ts', host='h0', cpu=100))
+    assert len(rule.matches) == 1
+
+    rule.add_data(hits(1, time_delta=datetime.timedelta(seconds=30), timestamp_field='ts', host='h0', cpu=100))
+    assert len(rule.matches) == 2
+    assert rule.evicted_keys['max_query_keys'] == 2
+
+
+def test_max_query_keys():
+
+    rule = percentile_rule(query_key='host', max_query_keys=3)
+    rule.add_data(keyed_events())
+
+    assert len(rule.cur_windows) <= 3
+    assert rule.evicted_keys['max_query_keys'] > 0
+    assert list(rule.last_seen) == list(sorted(rule.last_seen, key=rule.last_seen.get))
+
+
+class StubElasticsearch(object):
+    """ Answers the date_histogram + percentiles aggregations from a list of documents. """
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.queries = []
+
+    def search(self, index=None, body=None, **kwargs):
+        self.queries.append(body)
+        aggs = body['aggs']
+        if 'bucket_aggs' in aggs:
+            field = aggs['bucket_aggs']['terms']['field']
+            keys = sorted(set(document[field] for document in self.documents))
+            buckets = [dict(self.intervals([d for d in self.documents if d[field] == key], aggs['bucket_aggs']['aggs']),
+                            key=key) for key in keys]
+            aggregations = {'bucket_aggs': {'buckets': buckets}}
+        else:
+            aggregations = self.intervals(self.documents, aggs)
+        return {'hits': {'total': len(self.documents)}, 'aggregations': aggregations}
+
+    def intervals(self, documents, aggs):
+        assert aggs['interval_aggs']['date_histogram']['interval'] == '1s'
+        percentiles = aggs['interval_aggs']['aggs']['target_percentiles']['percentiles']
+        buckets = []
+        for ts in sorted(set(document['ts'] for document in documents)):
+            values = sorted(document[percentiles['field']] for document in documents if document['ts'] == ts)
+            ranked = dict(('%.1f' % percent, values[max(int(len(values) * percent / 100.0 + 0.5) - 1, 0)])
+                          for percent in percentiles['percents'])
+            buckets.append({'key_as_string': ts.isoformat(), 'doc_count': len(values),
+                            'target_percentiles': {'values': ranked}})
+        return {'interval_aggs': {'buckets': buckets}}
+
+
+def test_percentile_aggregation_mode():
+
+    for options in ({}, {'query_key': 'host'}):
+        documents = keyed_events()[:-1]
+        exact = percentile_rule(**options)
+        exact.add_data(documents)
+
+        rule = percentile_rule(use_percentile_aggregation=True, bucket_interval={'seconds': 1}, **options)
+        assert rule.window_mode == 'pane'
+
+        aggs = {'interval_aggs': {'date_histogram': {'field': 'ts', 'interval': rule.rules['bucket_interval_period']},
+                                  'aggs': rule.rules['aggregation_query_element']}}
+        if 'query_key' in options:
+            aggs = {'bucket_aggs': {'terms': {'field': 'host', 'size': 50}, 'aggs': aggs}}
+        es = StubElasticsearch(documents)
+        res = es.search(index='filebeat-access-*', body={'aggs': aggs}, size=0)
+        rule.add_aggregation_data({documents[-1]['ts']: res['aggregations']})
+
+        assert len(rule.matches) == len(exact.matches) > 0
+        assert sorted(m['ts'] for m in rule.matches) == sorted(m['ts'] for m in exact.matches)
+        if 'query_key' in options:
+            assert all('host' in match for match in rule.matches)
+
+
+def test_interval_period():
+
+    assert interval_period(datetime.timedelta(seconds=1)) == '1s'
+    assert interval_period(datetime.timedelta(minutes=2)) == '120s'
+    assert interval_period(datetime.timedelta(milliseconds=500)) == '500ms'
+    assert interval_period(datetime.timedelta(seconds=1.5)) == '1500ms'
+    for interval in (datetime.timedelta(0), datetime.timedelta(microseconds=1500), datetime.timedelta(seconds=-1)):
+        with pytest.raises(EAException):
+            interval_period(interval)
+
+    rule = percentile_rule(use_percentile_aggregation=True, window_mode='pane', bucket_interval={'milliseconds': 500})
+    assert rule.rules['bucket_interval_period'] == '500ms'
+
+
+def test_histogram_value_at():
+
+    rand = random.Random(3)
+    histogram = Histogram()
+    panes = []
+    for _ in range(300):
+        pane = Histogram()
+        for _ in range(rand.randint(0, 20)):
+            pane.add(rand.choice([rand.randint(0, 30), round(rand.lognormvariate(3, 1), 1)]), rand.randint(1, 3))
+        histogram.merge(pane)
+        panes.append(pane)
+        if len(panes) > 10:
+            histogram.subtract(panes.pop(0))
+
+        values = sorted(value for pane in panes for value, weight in pane.items() for _ in range(weight))
+        for p in (50, 90, 99, 10):
+            rank = int(len(values) * p / 100)
+            assert histogram.value_at(rank) == (values[rank] if values else 0)
+        assert histogram.value_at(-1) == (values[-1] if values else 0)
+
+
+def test_histogram_fractional_weights():
+
+    rand = random.Random(4)
+    weights = ['0.1', '0.2', '0.3', '0.7', '1.1', '2.05']
+    histogram = Histogram()
+    panes = []
+    for _ in range(400):
+        pane = Histogram()
+        exact = {}
+        for _ in range(rand.randint(0, 8)):
+            value = round(rand.lognormvariate(2, 0.5))
+            weight = rand.choice(weights)
+            pane.add(value, float(weight))
+            exact[value] = exact.get(value, 0) + Fraction(weight)
+        histogram.merge(pane)
+        panes.append((pane, exact))
+        if len(panes) > 10:
+            histogram.subtract(panes.pop(0)[0])
+
+        bins = {}
+        for _, exact in panes:
+            for value, weight in exact.items():
+                bins[value] = bins.get(value, 0) + weight
+        total = sum(bins.values())
+        assert len(histogram) == len(bins)
+        for p in (10, 50, 90, 99, 100):
+            # Same as list indexing, like the event windows
+            rank = int(total * p / 100) - 1
+            if rank < 0:
+                rank += total
+            rank = min(max(rank, 0), total - 1)
+            seen = 0
+            expected = 0
+            for value in sorted(bins):
+                seen += bins[value]
+                if seen > rank:
+                    expected = value
+                    break
+            if total:
+                assert histogram.value_at(percentile_rank(histogram.count, p)) == expected
+
+    # Drained, without residue
+    for pane, _ in panes:
+        histogram.subtract(pane)
+    assert histogram.count == 0
+    assert len(histogram) == 0
+    assert histogram.value_at(-1) == histogram.value_at(0) == 0
+
+
+def test_compact_window_mode():
+
+    for options in ({}, {'query_key': 'host'}):
+        exact = percentile_rule(**options)
+        compact = percentile_rule(window_mode='compact', **options)
+
+        for document in keyed_events():
+            exact.add_data([document])
+            compact.add_data([document])
+
+        for qk in exact.cur_windows:
+            assert exact.cur_windows[qk].count() == compact.cur_windows[qk].count()
+            assert exact.ref_windows[qk].count() == compact.ref_windows[qk].count()
+        assert exact.matches == compact.matches
+
+
+def test_compact_window_late_events():
+
+    timeframe = datetime.timedelta(seconds=10)
+    window = CustomEventWindow(timeframe, getTimestamp=lambda e: e[0]['ts'], p_value=50)
+    compact = CompactEventWindow(timeframe, ts_field='ts', p_value=50)
+
+    rand = random.Random(1)
+    for n, document in enumerate(hits(200, timestamp_field='ts')):
+        late = event(document['ts'] - datetime.timedelta(seconds=rand.randint(0, 5)), timestamp_field='ts')
+        for entry in ((document, n % 17), (late, n % 5)):
+            window.append(entry)
+            compact.append(entry)
+            assert window.count() == compact.count()
+            assert len(window.data) == len(compact)
+
+    assert [e['ts'] for e, _ in window.data] == [e['ts'] for e, _ in compact.data]
+
+
+def test_snapshot_restore(tmpdir):
+
+    path = str(tmpdir.join('percentile.state'))
+    documents = keyed_events()[:-1]
+    restart = 30 * 20
+
+    for options in ({}, {'window_mode': 'compact'}, {'window_mode': 'pane'}):
+        options['query_key'] = 'host'
+        running = percentile_rule(**options)
+        running.add_data(documents[:restart])
+        snapshot.save(running, path)
+
+        restarted = percentile_rule(**options)
+        assert snapshot.load(restarted, path, now=dt_to_epoch(documents[restart - 1]['ts'])) == 5
+        assert restarted.ref_window_filled_once
+        for qk in running.cur_windows:
+            assert restarted.cur_windows[qk].count() == running.cur_windows[qk].count()
+            assert restarted.ref_windows[qk].count() == running.ref_windows[qk].count()
+
+        running.add_data(documents[restart:])
+        restarted.add_data(documents[restart:])
+        assert len(restarted.matches) == len(running.matches) > 0
+        assert restarted.matches == running.matches
+
+
+def test_snapshot_discards_old_data(tmpdir):
+
+    path = str(tmpdir.join('percentile.state'))
+    running = percentile_rule(query_key='host')
+    running.add_data(keyed_events()[:-1])
+    snapshot.save(running, path)
+
+    restarted = percentile_rule(query_key='host')
+    assert snapshot.load(restarted, path, now=dt_to_epoch(ts_to_dt('2000-01-01T00:01:30Z'))) == 0
+    assert restarted.cur_windows == {}
+
+
+
+def test_metrics(tmpdir):
+
+    path = str(tmpdir.join('percentile.prom'))
+    rule = percentile_rule(query_key='host', metrics_file=path)
+    documents = keyed_events()
+    documents[0].pop('cpu')
+    rule.add_data(documents)
+
+    stats = rule.metrics.stats()
+    assert stats['events_ingested'] == len(documents) - 1
+    assert stats['events_dropped'] == 1
+    assert stats['matches'] == len(rule.matches) > 0
+    assert stats['evaluations'] > 0
+    assert stats['query_keys'] == len(rule.cur_windows) == 6
+    assert stats['window_sizes']['h0'] == len(rule.cur_windows['h0'].data) + len(rule.ref_windows['h0'].data)
+    assert stats['timings']['append']['count'] == stats['events_ingested']
+    assert stats['timings']['count']['count'] == stats['evaluations']
+    assert stats['timings']['match']['buckets'][-1][1] == stats['matches']
+
+    rule.garbage_collect(documents[-1]['ts'])
+    text = tmpdir.join('percentile.prom').read()
+    assert 'elastalert_custom_events_dropped_total{rule="PercentileOfFieldSpikeRule"} 1\n' in text
+    assert 'elastalert_custom_query_keys{rule="PercentileOfFieldSpikeRule"} 6\n' in text
+    assert 'elastalert_custom_stage_seconds_bucket{rule="PercentileOfFieldSpikeRule",stage="append",le="+Inf"} %d\n' % (
+        stats['events_ingested']) in text
+
+
+def test_find_first():
+
+    timeframe = datetime.timedelta(seconds=10)
+    windows = [CustomEventWindow(timeframe, getTimestamp=lambda e: e[0]['ts'], p_value=50),
+               CompactEventWindow(timeframe, ts_field='ts', p_value=50),
+               CompactEventWindow(timeframe, ts_field='ts'),
+               PaneEventWindow(timeframe, getTimestamp=lambda e: e[0]['ts'], p_value=50),
+               PaneEventWindow(timeframe, getTimestamp=lambda e: e[0]['ts'])]
+
+    rand = random.Random(2)
+    for n, document in enumerate(hits(300, timestamp_field='ts', time_delta=datetime.timedelta(milliseconds=300))):
+        late = event(document['ts'] - datetime.timedelta(seconds=rand.randint(0, 5)), timestamp_field='ts')
+        for entry in ((document, rand.randint(0, 40)), (late, rand.randint(0, 10))):
+            for window in windows:
+                window.append(entry)
+                data = list(window.data)
+                for count in (0, 5, 20, 39, 100):
+                    for strict in (False, True):
+                        expected = [e for e in data if e[1] > count or (e[1] == count and not strict)]
+                        assert window.find_first(count, strict) == (expected or data[-1:])[0]
+
+
+def test_find_first_after_late_event():
+
+    timeframe = datetime.timedelta(seconds=100)
+    start = ts_to_dt('2000-01-01T00:00:00Z')
+    for window in (CustomEventWindow(timeframe, getTimestamp=lambda e: e[0]['ts'], p_value=50),
+                   CompactEventWindow(timeframe, ts_field='ts'),
+                   PaneEventWindow(timeframe, getTimestamp=lambda e: e[0]['ts'])):
+        for n in range(8):
+            window.append((event(start + datetime.timedelta(seconds=n), timestamp_field='ts'), 1))
+        late = event(start + datetime.timedelta(seconds=3, milliseconds=500), timestamp_field='ts')
+        window.append((late, 50))
+        # Enough appends to fill the index before the next lookup
+        for n in range(8, 48):
+            window.append((event(start + datetime.timedelta(seconds=n), timestamp_field='ts'), 1))
+
+        match, count = window.find_first(50)
+        assert count >= 50
+        assert match['ts'] <= late['ts']
+
+
+def test_match_payload():
+
+    for window_mode in ('event', 'compact', 'pane'):
+        rule = percentile_rule(window_mode=window_mode)
+        rule.add_data(spike_events())
+
+        assert len(rule.matches) == 1
+        match = rule.matches[0]
+        assert match['percentile_value'] == 90
+        assert match['current_window_size'] > 0
+        assert match['reference_window_size'] > 0
+        assert 'Percentile 90 of ' in rule.get_match_str(match)
+
+
+def test_multiple_percentiles():
+
+    for window_mode in ('event', 'compact', 'pane'):
+        for percentile in (50, 90):
+            single = percentile_rule(window_mode=window_mode, percentile_value=percentile)
+            multiple = percentile_rule(window_mode=window_mode, percentile_value=[50, 90, 99],
+                                       spike_height={50: 2 if percentile == 50 else 100,
+                                                     90: 2 if percentile == 90 else 100,
+                                                     99: 100})
+            single.add_data(spike_events())
+            multiple.add_data(spike_events())
+
+            assert len(single.matches) == len(multiple.matches) == 1
+            spiking = multiple.matches[0].pop('spiking_percentiles')
+            assert single.matches == multiple.matches
+            assert spiking == [{'percentile': percentile,
+                                'current_count': single.matches[0]['current_count'],
+                                'reference_count': single.matches[0]['reference_count']}]
+            assert 'Percentile %d: ' % (percentile) in multiple.get_match_str(dict(multiple.matches[0],
+                                                                              spiking_percentiles=spiking))
+
+    with pytest.raises(EAException):
+        percentile_rule(percentile_value=[50, 90], spike_height={50: 2})
+
+
+def test_parallel_workers():
+
+    documents = keyed_events(keys=20)
+    serial = percentile_rule(query_key='host')
+    parallel = percentile_rule(query_key='host', workers=3)
+    try:
+        for page in range(0, len(documents), 100):
+            serial.add_data(documents[page:page + 100])
+            parallel.add_data(documents[page:page + 100])
+        assert len(serial.matches) > 1
+        assert parallel.matches == serial.matches
+        assert parallel.cur_windows == {}
+
+        parallel.garbage_collect(documents[-1]['ts'])
+        stats = parallel.metrics.stats()
+        assert stats['query_keys'] == len(serial.cur_windows)
+        assert stats['events_ingested'] == serial.metrics.counters['events_ingested']
+        assert stats['matches'] == len(serial.matches)
+    finally:
+        parallel.pool.close()
+
+    with pytest.raises(EAException):
+        percentile_rule(workers=2)
+    with pytest.raises(EAException):
+        percentile_rule(query_key='host', alert_on_new_data=True, workers=2)
+
+
+def test_parallel_worker_died():
+
+    documents = keyed_events(keys=20)
+    rule = percentile_rule(query_key='host', workers=2)
+    pool = rule.pool
+    try:
+        rule.add_data(documents[:100])
+        pool.processes[0].terminate()
+        pool.processes[0].join()
+
+        with mock.patch('custom.ruletypes.elastalert_logger') as logger:
+            rule.add_data(documents[100:200])
+        assert logger.error.called
+        assert rule.pool is None
+        assert pool.processes == []
+        assert rule.cur_windows
+
+        rule.add_data(documents[200:])
+        rule.garbage_collect(documents[-1]['ts'])
+    finally:
+        pool.terminate()
+
+
+def test_field_getter():
+
+    documents = [{'a': {'b': {'c': 1}}}, {'a.b': {'c': 2}}, {'a': {'b.c': 3}}, {'a.b.c': 4},
+                 {'a': {'b': 'text'}}, {'b': 6}, {}]
+    for field in ('a.b.c', 'a.b', 'a', 'b'):
+        get = fields.field_getter(field)
+        for document in documents:
+            assert get(document) == lookup_es_key(document, field)
+
+
+def test_missing_field_diagnostics():
+
+    documents = keyed_events()
+    documents[0].pop('cpu')
+    documents[1].pop('ts')
+    documents[2]['cpu'] = 0
+
+    for options in ({}, {'batch_ingest': True}):
+        rule = percentile_rule(query_key='host', diagnostics_interval=0, **options)
+        with mock.patch('custom.fields.elastalert_logger') as logger:
+            rule.add_data(documents)
+            assert not logger.warning.called
+            rule.garbage_collect(documents[-1]['ts'])
+            assert logger.warning.call_count == 1
+
+        message = logger.warning.call_args[0][0]
+        assert '1 with a zero cpu, 1 without cpu, 1 without ts, 1 without query_key host' in message
+        assert rule.diagnostics.counts == {}
+
+
+def test_dedupe_key():
+
+    documents = keyed_events()
+    for n, document in enumerate(documents):
+        document['_id'] = str(n)
+
+    once = percentile_rule(query_key='host')
+    once.add_data(documents)
+    for options in ({}, {'batch_ingest': True}):
+        overlapping = percentile_rule(query_key='host', dedupe_key='_id', buffer_time=datetime.timedelta(seconds=2),
+                                      **options)
+        # Pages of 10 seconds of documents, each starting 2 seconds before the previous one ended
+        for start in range(0, len(documents), 8 * 20):
+            overlapping.add_data(documents[start:start + 10 * 20])
+
+        assert overlapping.matches == once.matches
+        assert overlapping.metrics.counters['events_duplicate'] == sum(
+            min(2 * 20, len(documents) - start) for start in range(8 * 20, len(documents), 8 * 20))
+        assert len(overlapping.duplicates) <= 3 * 20 + 1
+
+
+def test_replay(tmpdir):
+
+    direct = percentile_rule()
+    direct.add_data(spike_events())
+
+    lines = [json.dumps({'_id': str(n), '_source': dict(document, ts=dt_to_ts(document['ts']))})
+             for n, document in enumerate(spike_events())]
+    plain = tmpdir.join('hits.ndjson')
+    plain.write('\n'.join(lines[:600]) + '\n\n')
+    compressed = tmpdir.join('hits.ndjson.gz')
+    with gzip.open(str(compressed), 'wb') as f:
+        f.write('\n'.join(lines[600:]))
+    tmpdir.join('empty.ndjson').write('')
+
+    documents = replay.read_hits([str(plain), str(tmpdir.join('empty.ndjson')), str(compressed)], 'ts')
+    matches = []
+    stats = replay.replay(percentile_rule(), documents, batch_size=100, on_match=matches.append)
+
+    assert stats['documents'] == len(lines)
+    assert stats['matches'] == len(matches) == len(direct.matches) == 1
+    assert matches[0]['ts'] == direct.matches[0]['ts']
+    assert matches[0]['current_count'] == direct.matches[0]['current_count']
+
+    assert replay.parse_override('timeframe={minutes: 5}') == ('timeframe', {'minutes': 5})
+    plain.write('{"ts":')
+    with pytest.raises(EAException):
+        list(replay.read_hits([str(plain)]))
+
+
+def test_iso_to_dt():
+
+    for timestamp in ('2000-01-01T00:00:00Z', '2000-01-01T00:00:00.123Z', '2017-05-03T10:20:30.5+02:00',
+                      '2017-05-03 10:20:30-0330', '2017-05-03T10:20:30', '2017-05-03T10:20:30.1234567Z',
+                      'May 3 2017'):
+        assert iso_to_dt(timestamp) == ts_to_dt(timestamp)
+        assert iso_to_dt(timestamp).utcoffset() == ts_to_dt(timestamp).utcoffset()
+
+
+def test_rule_group():
+
+    percentile = {'name': 'percentile', 'type': 'custom.ruletypes.PercentileOfFieldSpikeRule',
+                  'percentile_value': 90}
+    frequency = {'name': 'sum', 'type': 'examp.ruletypes.SumOfFieldFrequencyRule', 'num_events': 3000}
+    sum_spike = {'name': 'sum spike', 'type': 'examp.ruletypes.SumOfFieldSpikeRule', 'spike_height': 2.5,
+                 'timeframe': {'seconds': 10}}
+    group_options = {'name': 'group', 'rules': [percentile, frequency, sum_spike], 'threshold_cur': 10,
+                     'spike_height': 2, 'timeframe': datetime.timedelta(seconds=5), 'spike_type': 'up',
+                     'target_field': 'cpu', 'timestamp_field': 'ts'}
+
+    with mock.patch('custom.columns.extract', wraps=columns.extract) as extract:
+        group = RuleGroup(dict(group_options))
+        group.add_data(spike_events())
+        group.garbage_collect(ts_now())
+    # ts and cpu, once for all the rules
+    assert extract.call_count == 2
+
+    for options in (percentile, frequency, sum_spike):
+        rule = group_module.get_rule_type(options['type'])(group_module.member_rules(group_options, options))
+        rule.add_data(spike_events())
+        rule.garbage_collect(ts_now())
+
+        found = [match for match in group.matches if match['rule_group_member'] == options['name']]
+        assert rule.matches
+        assert [dict(match, rule_group_member=options['name']) for match in rule.matches] == found
+        assert group.get_match_str(found[0]).endswith(rule.get_match_str(rule.matches[0]))
+
+    with pytest.raises(EAException):
+        RuleGroup(dict(group_options, rules=[dict(percentile, filter=[])]))
+    with pytest.raises(EAException):
+        RuleGroup(dict(group_options, rules=[percentile, percentile]))
@@ -7,6 +7,11 @@ from elastalert.util import EAException
 from elastalert.util import ts_now
 from elastalert.util import ts_to_dt
 
+from examp.ruletypes import SumOfFieldFrequencyRule
+from examp.ruletypes import SumOfFieldSpikeRule
+from custom import snapshot
+from custom.util import dt_to_epoch
+
 #custom.custom_rule2.SpikeAggregationRule
 def hits(size, **kwargs):
     ret = []
@@ -58,4 +63,210 @@ def _test_rule():
     rules['query_key'] = 'qk'
     rule = MetricAggregationRule(rules)
     rule.check_matches(datetime.datetime.now(), 'qk_val', {'cpu_pct_avg': {'value': 0.95}})
-    assert rule.matches[0]['qk'] == 'qk_val'
\ No newline at end of file
+    assert rule.matches[0]['qk'] == 'qk_val'
+
+
+def sum_spike_rule(**kwargs):
+    rules = {'name': 'SumOfFieldSpikeRule',
+             'threshold_cur': 10,
+             'spike_height': 2,
+             'timeframe': datetime.timedelta(seconds=10),
+             'spike_type': 'up',
+             'target_field': 'bytes',
+             'timestamp_field': '@timestamp'}
+    rules.update(kwargs)
+    return SumOfFieldSpikeRule(rules)
+
+
+def spike_hits():
+    events = []
+    for n in range(60):
+        ts = ts_to_dt('2000-01-01T00:%s:%sZ' % (n / 60, n % 60))
+        for _ in range(10):
+            events.append(create_event(ts, bytes=100 if 40 <= n < 45 else 10))
+    return events
+
+
+def test_pane_window_mode():
+    event_rule = sum_spike_rule()
+    pane_rule = sum_spike_rule(window_mode='pane', window_resolution={'seconds': 1})
+
+    for document in spike_hits():
+        event_rule.add_data([document])
+        pane_rule.add_data([document])
+        assert event_rule.cur_windows['all'].count() == pane_rule.cur_windows['all'].count()
+        assert event_rule.ref_windows['all'].count() == pane_rule.ref_windows['all'].count()
+
+    assert len(event_rule.matches) == len(pane_rule.matches) == 1
+    assert event_rule.matches[0]['@timestamp'] == pane_rule.matches[0]['@timestamp']
+    assert len(pane_rule.cur_windows['all'].panes) <= 10
+
+
+def test_match_payload():
+    for window_mode in ('event', 'compact', 'pane'):
+        rule = sum_spike_rule(window_mode=window_mode)
+        with mock.patch('elastalert.ruletypes.SpikeRule.add_match') as add_match:
+            rule.add_data(spike_hits())
+        assert not add_match.called
+
+        assert len(rule.matches) == 1
+        match = rule.matches[0]
+        assert match['spike_count'] >= 2 * match['reference_count'] > 0
+        assert match['current_window_size'] > 0
+        assert match['reference_window_size'] > 0
+
+
+def test_batch_ingest():
+    documents = spike_hits()
+    documents[5]['bytes'] = '10'
+    documents[6]['bytes'] = 'ten'
+    documents[7].pop('bytes')
+
+    # Counts which can't bring the sum to threshold_cur are appended in runs
+    for options in ({}, {'threshold_cur': 1500}, {'threshold_cur': 1500, 'window_mode': 'pane'}):
+        single = sum_spike_rule(**options)
+        batch = sum_spike_rule(batch_ingest=True, **options)
+
+        single.add_data(documents)
+        batch.add_data(documents)
+
+        assert len(single.matches) == 1
+        assert single.matches == batch.matches
+        assert single.cur_windows['all'].count() == batch.cur_windows['all'].count()
+        assert single.ref_windows['all'].count() == batch.ref_windows['all'].count()
+        if 'threshold_cur' in options:
+            assert batch.metrics.counters['evaluations'] < single.metrics.counters['evaluations']
+
+
+def test_compact_window_mode():
+    event_rule = sum_spike_rule()
+    compact_rule = sum_spike_rule(window_mode='compact')
+
+    for document in spike_hits():
+        event_rule.add_data([document])
+        compact_rule.add_data([document])
+        assert event_rule.cur_windows['all'].count() == compact_rule.cur_windows['all'].count()
+        assert event_rule.ref_windows['all'].count() == compact_rule.ref_windows['all'].count()
+
+    assert event_rule.matches == compact_rule.matches
+
+
+def test_snapshot_restore(tmpdir):
+    path = str(tmpdir.join('sum.state'))
+    documents = spike_hits()
+    restart = 30 * 10
+
+    running = sum_spike_rule()
+    running.add_data(documents[:restart])
+    snapshot.save(running, path)
+
+    restarted = sum_spike_rule(state_file=path)
+    assert restarted.cur_windows == {}
+    snapshot.load(restarted, path, now=dt_to_epoch(documents[restart - 1]['@timestamp']))
+    assert restarted.cur_windows['all'].count() == running.cur_windows['all'].count()
+
+    running.add_data(documents[restart:])
+    restarted.add_data(documents[restart:])
+    assert len(restarted.matches) == len(running.matches) == 1
+    assert restarted.matches == running.matches
+
+
+
+def test_metrics():
+    single = sum_spike_rule()
+    batch = sum_spike_rule(batch_ingest=True)
+
+    documents = spike_hits()
+    documents[7].pop('bytes')
+    single.add_data(documents)
+    batch.add_data(documents)
+
+    for rule in (single, batch):
+        stats = rule.metrics.stats()
+        assert stats['events_ingested'] == len(documents) - 1
+        assert stats['events_dropped'] == 1
+        assert stats['matches'] == 1
+        assert stats['query_keys'] == 1
+        assert stats['timings']['count']['count'] == stats['evaluations'] > 0
+    assert '# TYPE elastalert_custom_stage_seconds histogram' in single.metrics.prometheus()
+
+
+def test_coalesce_counts():
+    single = sum_spike_rule()
+    single.add_data(spike_hits())
+
+    for options in ({}, {'batch_ingest': True}, {'coalesce_interval': {'seconds': 2}}):
+        coalesced = sum_spike_rule(coalesce_counts=True, **options)
+        coalesced.add_data(spike_hits())
+
+        assert len(coalesced.matches) == len(single.matches) == 1
+        assert coalesced.matches[0]['@timestamp'] == single.matches[0]['@timestamp']
+        stats = coalesced.metrics.stats()
+        assert stats['events_ingested'] < len(spike_hits()) / 4
+        assert stats['events_ingested'] + stats['events_coalesced'] == len(spike_hits())
+
+
+def test_coalesce_counts_matches():
+    # A match clears the windows, the rest of the documents of its timestamp
+    # must start new ones like they do without coalescing
+    documents = [create_event(ts_to_dt('2000-01-01T00:00:0%sZ' % (n)), bytes=30) for n in range(5) for _ in range(10)]
+    for options in ({}, {'batch_ingest': True}):
+        rules = {'name': 'SumOfFieldFrequencyRule',
+                 'num_events': 100,
+                 'timeframe': datetime.timedelta(seconds=10),
+                 'target_field': 'bytes',
+                 'timestamp_field': '@timestamp'}
+        rules.update(options)
+        single = SumOfFieldFrequencyRule(dict(rules))
+        coalesced = SumOfFieldFrequencyRule(dict(rules, coalesce_counts=True))
+        single.add_data(documents)
+        coalesced.add_data(documents)
+        assert len(coalesced.matches) == len(single.matches) == 12
+
+    documents = spike_hits() + [create_event(ts_to_dt('2000-01-01T00:01:%sZ' % (n)), bytes=1)
+                                for n in range(20) for _ in range(10)]
+    for spike_type, count in (('up', 1), ('down', 2), ('both', 2)):
+        for options in ({}, {'batch_ingest': True}, {'window_mode': 'pane'}):
+            single = sum_spike_rule(spike_type=spike_type, **options)
+            coalesced = sum_spike_rule(spike_type=spike_type, coalesce_counts=True, **options)
+            single.add_data(documents)
+            coalesced.add_data(documents)
+
+            assert len(coalesced.matches) == len(single.matches) == count
+            for match, expected in zip(coalesced.matches, single.matches):
+                for field in ('@timestamp', 'spike_count', 'reference_count'):
+                    assert match[field] == expected[field]
+            assert coalesced.metrics.stats()['events_coalesced'] > 0
+
+
+def test_missing_field_diagnostics():
+    documents = spike_hits()
+    documents[5]['bytes'] = 'ten'
+    documents[6].pop('bytes')
+    documents[7].pop('@timestamp')
+
+    for options in ({}, {'batch_ingest': True}):
+        rule = sum_spike_rule(diagnostics_interval=0, **options)
+        with mock.patch('examp.ruletypes.elastalert_logger') as rule_logger:
+            with mock.patch('custom.fields.elastalert_logger') as logger:
+                rule.add_data(documents)
+                assert not logger.warning.called
+                rule.garbage_collect(documents[-1]['@timestamp'])
+        assert not rule_logger.warning.called
+        assert logger.warning.call_count == 1
+        assert '1 with a non-integer bytes, 1 without @timestamp, 1 without bytes' in logger.warning.call_args[0][0]
+
+
+def test_dedupe_key():
+    documents = spike_hits()
+    for n, document in enumerate(documents):
+        document['request'] = {'id': n}
+
+    once = sum_spike_rule()
+    once.add_data(documents)
+    overlapping = sum_spike_rule(dedupe_key='request.id', buffer_time=datetime.timedelta(seconds=5))
+    for start in range(0, len(documents), 50):
+        overlapping.add_data(documents[max(start - 30, 0):start + 50])
+
+    assert overlapping.matches == once.matches
+    assert overlapping.metrics.counters['events_duplicate'] == 30 * (len(documents) / 50 - 1)